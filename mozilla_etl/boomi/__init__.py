@@ -1,22 +1,50 @@
 __all__ = [
-    "add_default_arguments", "add_default_services", "HeaderlessCsvWriter"
+    "add_default_arguments", "add_default_services", "HeaderlessCsvWriter",
+    "BulkInsertOrUpdate", "FanOutInsertOrUpdate", "DimensionCache",
+    "lookup_dimensions", "SourceStateStore", "SumAccumulator", "apply_retention",
+    "create_pooled_engine", "default_plugins", "HashJoin", "InsertMultiple",
+    "Instrumentation", "lazy", "max_keys_for", "RecordSubmitted", "resolve",
+    "SkipSubmitted", "StreamingSelect", "SubmissionLedger", "CachingTransport",
+    "WsdlCache", "CommitSnapshots", "SkipUnchanged", "SnapshotStore",
+    "CachingAdapter", "PublishingFS", "BrickFTPFS", "DateParser",
+    "date_parsers"
 ]
 
 import os
 import fs
 import bonobo
 
-from sqlalchemy import create_engine
 from fs.sshfs import SSHFS
 
 from dateutil import parser as dateparser
 import datetime
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 from bonobo.config import use_context
 
+from .aggregation import SumAccumulator, max_keys_for
+from .brickftp import BrickFTPFS
+from .bulk import BulkInsertOrUpdate, FanOutInsertOrUpdate
+from .dates import DateParser, date_parsers
+from .dimensions import DimensionCache, lookup_dimensions
+from .instrumentation import Instrumentation, instrument_services
+from .join import HashJoin
+from .ledger import RecordSubmitted, SkipSubmitted, SubmissionLedger
+from .publish import PublishingFS
+from .readers import StreamingSelect
+from .retention import apply_retention
+from .servicenow import InsertMultiple
+from .services import create_pooled_engine, lazy, resolve
+from .snapshots import CommitSnapshots, SkipUnchanged, SnapshotStore
+from .state import SourceStateStore
+from .wsdl import CachingTransport, WsdlCache
+from .httpcache import CachingAdapter, HTTP_CACHE_SIZE, HTTP_CACHE_TTLS, parse_ttl
+
+HTTP_POOL_SIZE = 16
+
 
 @use_context
 class HeaderlessCsvWriter(bonobo.CsvWriter):
@@ -44,57 +72,85 @@ def valid_date(s):
         raise argparse.ArgumentTypeError(msg)
 
 
-def add_default_services(services, options):
-    services['mysql'] = create_engine(
-        'mysql+mysqldb://localhost/aws', echo=False)
+def _publishing(open_fs, *args, **kwargs):
+    return PublishingFS(open_fs(*args, **kwargs))
+
+
+def _http_session(username, password, cache=None):
+    session = requests.Session()
+
+    session.headers = {'User-Agent': 'Mozilla/ETL/v1'}
+    session.auth = HTTPBasicAuth(username, password)
+    session.headers.update({'Accept-encoding': 'text/json'})
+
+    # Enough keep-alive connections for nodes posting concurrently
+    if cache:
+        adapter = CachingAdapter(
+            pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, **cache)
+    else:
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 
-    services['redshift'] = create_engine(
-        options['redshift'].format(
+def _http_cache(options, name):
+    # Each service gets its own store, shared by all the jobs using it
+    if not options['use_cache']:
+        return None
+
+    return {
+        'path': os.path.join(options['http_cache'], name),
+        'ttls': (options['http_cache_ttl'] or []) + list(HTTP_CACHE_TTLS),
+        'max_size': options['http_cache_size'] * 1024 * 1024,
+    }
+
+
+def add_default_services(services, options):
+    """
+    Register the shared engines, filesystems and http sessions. None of them
+    is built until a node uses it, and the same instance is then reused by all
+    the bonobo.run() calls sharing services.
+    """
+    services['mysql'] = lazy(create_pooled_engine,
+                             'mysql+mysqldb://localhost/aws')
+
+    services['redshift'] = lazy(
+        create_pooled_engine, options['redshift'].format(
             host=options['redshift_host'],
             port=options['redshift_port'],
             name=options['redshift_name'],
             username=options['redshift_username'],
-            password=options['redshift_password']),
-        echo=False)
+            password=options['redshift_password']))
 
-    services['vertica'] = create_engine(
-        options['vertica'].format(
+    services['vertica'] = lazy(
+        create_pooled_engine, options['vertica'].format(
             host=options['vertica_host'],
             port=options['vertica_port'],
             name=options['vertica_name'],
             username=options['vertica_username'],
-            password=options['vertica_password']),
-        echo=False)
+            password=options['vertica_password']))
 
+    # Only upload the files written to brickftp when they changed
     if options['local']:
-        services['brickftp'] = fs.open_fs("file:///tmp/etl")
-        services['centerstone'] = fs.open_fs("file:///tmp/etl")
+        services['brickftp'] = lazy(_publishing, fs.open_fs,
+                                    "file:///tmp/etl")
+        services['centerstone'] = lazy(fs.open_fs, "file:///tmp/etl")
     else:
-        services['brickftp'] = fs.open_fs(
-            "ssh://%s@%s" % (options['brickftp_username'],
-                             options['brickftp_host']))
-        # Bug workaround to brickftp's sftp-only server
-        services['brickftp']._platform = "Linux"
-        services['centerstone'] = fs.open_fs(
-            "ssh://MozillaBrickFTP@ftp.asset-fm.com:/Out/"),
-
-    if options['use_cache']:
-        from requests_cache import CachedSession
-        services['servicenow'] = CachedSession('http.cache')
-        services['workday'] = CachedSession('http.cache')
-    else:
-        services['servicenow'] = requests.Session()
-        services['workday'] = requests.Session()
-
-    services['servicenow'].headers = {'User-Agent': 'Mozilla/ETL/v1'}
-    services['servicenow'].auth = HTTPBasicAuth(options['sn_username'],
-                                                options['sn_password'])
-    services['servicenow'].headers.update({'Accept-encoding': 'text/json'})
-
-    services['workday'].headers = {'User-Agent': 'Mozilla/ETL/v1'}
-    services['workday'].auth = HTTPBasicAuth(options['wd_username'],
-                                             options['wd_password'])
-    services['workday'].headers.update({'Accept-encoding': 'text/json'})
+        services['brickftp'] = lazy(
+            _publishing,
+            BrickFTPFS,
+            options['brickftp_host'],
+            user=options['brickftp_username'])
+        services['centerstone'] = lazy(
+            fs.open_fs, "ssh://MozillaBrickFTP@ftp.asset-fm.com:/Out/")
+
+    services['servicenow'] = lazy(_http_session, options['sn_username'],
+                                  options['sn_password'],
+                                  _http_cache(options, 'servicenow'))
+    services['workday'] = lazy(_http_session, options['wd_username'],
+                               options['wd_password'],
+                               _http_cache(options, 'workday'))
 
     # Set a file suffix for non-prod jobs
     if options['environment'] == "prod":
@@ -104,9 +160,22 @@ def add_default_services(services, options):
         options['suffix'] = '.' + options['environment']
         options['table_suffix'] = '_' + options['environment']
 
+    if options['metrics_report'] or options['metrics_textfile']:
+        instrumentation = Instrumentation(options['metrics_report'],
+                                          options['metrics_textfile'])
+        instrument_services(instrumentation, services)
+        services['instrumentation'] = instrumentation
+
     return
 
 
+def default_plugins(services):
+    """Plugins to pass to bonobo.run() along with add_default_services()"""
+    if 'instrumentation' in services:
+        return [services['instrumentation']]
+    return []
+
+
 def add_default_arguments(parser):
     parser.add_argument(
         '--vertica-username',
@@ -204,7 +273,39 @@ def add_default_arguments(parser):
     parser.add_argument(
         '--local', action='store_true', default=os.getenv('LOCAL', False))
 
-    parser.add_argument('--use-cache', action='store_true', default=False)
+    parser.add_argument(
+        '--use-cache',
+        action='store_true',
+        default=False,
+        help='Cache Workday and ServiceNow responses on disk')
+    parser.add_argument(
+        '--http-cache',
+        type=str,
+        default=os.getenv('BOOMI_HTTP_CACHE', 'http.cache'),
+        help='Where to keep them, one directory per service')
+    parser.add_argument(
+        '--http-cache-ttl',
+        type=parse_ttl,
+        action='append',
+        metavar='PATTERN=SECONDS',
+        help='How long responses for URLs matching PATTERN stay fresh')
+    parser.add_argument(
+        '--http-cache-size',
+        type=int,
+        default=HTTP_CACHE_SIZE // (1024 * 1024),
+        help='Megabytes kept per service before evicting')
+
+    parser.add_argument(
+        '--metrics-report',
+        type=str,
+        default=os.getenv('BOOMI_METRICS_REPORT'),
+        help='Write node and service timings as JSON after each run')
+    parser.add_argument(
+        '--metrics-textfile',
+        type=str,
+        default=os.getenv('BOOMI_METRICS_TEXTFILE'),
+        help='Write them to a Prometheus textfile collector file too')
+
     parser.add_argument('--sn-username', type=str, default='mozvending'),
     parser.add_argument(
         '--sn-password', type=str, default=os.getenv("SN_PASSWORD")),
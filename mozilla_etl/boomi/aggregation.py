@@ -0,0 +1,89 @@
+import heapq
+import os
+import pickle
+import tempfile
+
+# Rough size of one accumulator entry: a 3-tuple key, its values, a float and
+# the dict slot holding them.
+ENTRY_SIZE = 320
+
+
+def max_keys_for(budget):
+    """Number of accumulator entries fitting in a memory budget, in MB"""
+    if not budget:
+        return None
+    return max(1, int(budget * 1024 * 1024 / ENTRY_SIZE))
+
+
+class SumAccumulator:
+    """
+    Sums values by tuple key.
+
+    When more than max_keys distinct keys are held, the partial sums are
+    spilled to a temporary file sorted by key, and items() merges all of
+    the spilled runs back together. Partial sums of a key are added in input
+    order, so only floating point rounding on keys that were spilled can
+    differ from a purely in-memory sum.
+    """
+
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys
+        self.sums = {}
+        self.runs = []
+
+    def __bool__(self):
+        return bool(self.sums or self.runs)
+
+    def add(self, key, value):
+        try:
+            self.sums[key] += value
+        except KeyError:
+            self.sums[key] = value
+            if self.max_keys and len(self.sums) > self.max_keys:
+                self.spill()
+
+    def spill(self):
+        fd, path = tempfile.mkstemp(suffix='.spill')
+        with os.fdopen(fd, 'wb') as file:
+            for item in sorted(self.sums.items()):
+                pickle.dump(item, file, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(path)
+        self.sums = {}
+
+    def items(self):
+        """Yield all (key, sum) pairs, and reset the accumulator"""
+        if not self.runs:
+            sums, self.sums = self.sums, {}
+            yield from sums.items()
+            return
+
+        if self.sums:
+            self.spill()
+
+        runs, self.runs = self.runs, []
+        try:
+            key, total = None, None
+            # Equal keys come out in run order, which is input order
+            merged = heapq.merge(
+                *map(_read_run, runs), key=lambda item: item[0])
+            for item_key, value in merged:
+                if item_key == key:
+                    total += value
+                else:
+                    if key is not None:
+                        yield key, total
+                    key, total = item_key, value
+            if key is not None:
+                yield key, total
+        finally:
+            for path in runs:
+                os.unlink(path)
+
+
+def _read_run(path):
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                yield pickle.load(file)
+            except EOFError:
+                return
@@ -1,5 +1,4 @@
 import bonobo
-import bonobo_sqlalchemy
 import requests
 import os
 
@@ -63,13 +62,12 @@ def get_graph(**options):
         split_dbs,
         _name="main")
 
-    for engine in list(set(options['engine'])):
-        graph.add_chain(
-            bonobo_sqlalchemy.InsertOrUpdate(
-                table_name=options['table_name'] + options['table_suffix'],
-                discriminant=('linked_account_number', ),
-                engine=engine),
-            _input=split_dbs)
+    graph.add_chain(
+        FanOutInsertOrUpdate(
+            table_name=options['table_name'] + options['table_suffix'],
+            discriminant=('linked_account_number', ),
+            engines=options['engine']),
+        _input=split_dbs)
 
     return graph
 
@@ -99,7 +97,7 @@ if __name__ == '__main__':
 
         __package__ = '.'.join(me)
 
-    from ... import add_default_arguments, add_default_services
+    from ... import add_default_arguments, add_default_services, default_plugins, FanOutInsertOrUpdate
 
     parser = bonobo.get_argument_parser()
 
@@ -113,4 +111,7 @@ if __name__ == '__main__':
     with bonobo.parse_args(parser) as options:
         services = get_services(**options)
         add_default_services(services, options)
-        bonobo.run(get_graph(**options), services=services)
+        bonobo.run(
+            get_graph(**options),
+            services=services,
+            plugins=default_plugins(services))
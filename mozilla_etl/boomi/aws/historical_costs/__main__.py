@@ -1,19 +1,44 @@
 import argparse
+import codecs
+import collections
+import concurrent.futures
+import csv
+import multiprocessing
+import os
+import re
+import traceback
+from queue import Empty
 
 import datetime
 from dateutil import parser as dateparser
 from dateutil.relativedelta import relativedelta
 
-import bonobo_sqlalchemy
-
 import boto3
 
 import bonobo
-from bonobo.config import use, use_context, use_raw_input, use_context_processor
+from bonobo.config import use, use_context, use_no_input, use_raw_input, use_context_processor
+from bonobo.config.functools import transformation_factory
 from bonobo.constants import NOT_MODIFIED
 
-from sqlalchemy import create_engine, Table, MetaData
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine
+
+from mozilla_etl.boomi.dates import date_parsers
+
+BILLING_BUCKET = 'mozilla-programmatic-billing'
+BILLING_KEY = '{account}-aws-cost-allocation-{month}.csv'
+BILLING_KEY_RE = re.compile(
+    r'^\d+-aws-cost-allocation-(?P<month>\d{4}-\d{2})\.csv$')
+
+# Ranged GET size when streaming billing files out of S3
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Rows per message sent back by the parser processes
+BATCH_SIZE = 1000
+
+
+def billing_fields(headers):
+    """Lowercase column headers and convert ':' to SQL safe '_'s"""
+    return [field.lower().replace(':', '_') for field in headers]
 
 
 # We should lowercase fields and all here
@@ -30,18 +55,231 @@ class AwsBillingReader(bonobo.CsvReader):
 
         if not context.output_type:
             # Initial row contains the column headers
-            self.fields = next(reader)
+            self.fields = billing_fields(next(reader))
 
-            # Lowercase them all
-            self.fields = list(map(lambda x: x.lower(), *self.fields))
+            context.set_output_fields(self.fields)
 
-            # Convert ':' to SQL safe '_'s
-            self.fields = list(
-                map(lambda x: x.replace(':', '_'), *self.fields))
+        return super(AwsBillingReader, self).__call__(file, context, fs=fs)
 
-            context.set_output_fields(*self.fields)
 
-        return super(AwsBillingReader, self).__call__(file, context, fs=fs)
+def _s3_lines(bucket, key, chunk_size, offset=0, size=None):
+    """Stream an S3 object with ranged GETs, yielding decoded lines"""
+    client = boto3.client('s3')
+    if size is None:
+        size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    decoder = codecs.getincrementaldecoder('utf-8')()
+
+    pending = ''
+    while offset < size:
+        resp = client.get_object(
+            Bucket=bucket,
+            Key=key,
+            Range='bytes=%d-%d' % (offset, offset + chunk_size - 1))
+        chunk = resp['Body'].read()
+        offset += len(chunk)
+
+        # Hold on to a trailing partial line until the next chunk
+        *lines, pending = (pending + decoder.decode(
+            chunk, final=offset >= size)).split('\n')
+
+        for line in lines:
+            yield line + '\n'
+
+    if pending:
+        yield pending
+
+
+def _parse_month(bucket, key, chunk_size, limit, queue):
+    """Process pool worker, parse one month and push row batches to queue"""
+    try:
+        size = boto3.client('s3').head_object(
+            Bucket=bucket, Key=key)['ContentLength']
+        reader = csv.reader(_s3_lines(bucket, key, chunk_size, size=size))
+
+        # Discard useless header amazon message
+        next(reader)
+        queue.put(('fields', key, billing_fields(next(reader))))
+
+        batch, count = [], 0
+        for row in reader:
+            if limit and count >= limit:
+                break
+            batch.append(tuple(row))
+            count += 1
+            if len(batch) >= BATCH_SIZE:
+                queue.put(('rows', key, batch))
+                batch = []
+
+        if batch:
+            queue.put(('rows', key, batch))
+
+        queue.put(('done', key, (count, size)))
+    except Exception:
+        queue.put(('error', key, traceback.format_exc()))
+
+
+@transformation_factory
+def AwsBillingMonthsReader(keys,
+                           bucket=BILLING_BUCKET,
+                           workers=None,
+                           chunk_size=CHUNK_SIZE,
+                           queue_size=16,
+                           limit=None,
+                           on_done=None):
+    """
+    Read many monthly billing files at once, each one streamed from S3 and
+    parsed in its own process. At most queue_size batches of rows are kept
+    waiting for the graph, which blocks the parsers when it can't keep up.
+
+    on_done(key, rows, size) is called as each file is fully read.
+    """
+    keys = list(keys)
+
+    @use_context
+    @use_no_input
+    def _AwsBillingMonthsReader(context):
+        fields, remap = None, {}
+        pending = set(keys)
+
+        # Manager goes away first on the way out, so parsers blocked on a
+        # full queue fail instead of keeping the pool from shutting down.
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count()) as pool, \
+                multiprocessing.Manager() as manager:
+            queue = manager.Queue(maxsize=queue_size)
+
+            futures = [
+                pool.submit(_parse_month, bucket, key, chunk_size, limit,
+                            queue) for key in keys
+            ]
+
+            while pending:
+                try:
+                    kind, key, data = queue.get(timeout=1)
+                except Empty:
+                    for future in futures:
+                        if future.done() and future.exception():
+                            raise future.exception()
+                    continue
+
+                if kind == 'fields':
+                    if fields is None:
+                        fields = data
+                        context.set_output_fields(fields)
+                    # Months with a different column set are realigned on
+                    # the columns of the first one, which can't hold more
+                    if data != fields:
+                        extra = [f for f in data if f not in fields]
+                        if extra:
+                            raise RuntimeError(
+                                "%s has columns the first month read "
+                                "lacks: %s" % (key, ', '.join(extra)))
+                        missing = [f for f in fields if f not in data]
+                        if missing:
+                            print("# %s lacks columns, left empty: %s" %
+                                  (key, ', '.join(missing)))
+                        remap[key] = [
+                            data.index(f) if f in data else None
+                            for f in fields
+                        ]
+
+                elif kind == 'rows':
+                    if key in remap:
+                        for row in data:
+                            yield tuple(row[i] if i is not None else ''
+                                        for i in remap[key])
+                    else:
+                        yield from data
+
+                elif kind == 'done':
+                    rows, size = data
+                    print("# Read %d rows from %s" % (rows, key))
+                    pending.discard(key)
+                    if on_done and not limit:
+                        on_done(key, rows, size)
+
+                else:
+                    raise RuntimeError(
+                        "Failed to read %s:\n%s" % (key, data))
+
+    return _AwsBillingMonthsReader
+
+
+class BillingState:
+    """
+    Tracks which billing files were already loaded, by ETag and size, so
+    unchanged months are skipped. Months that changed are read again in
+    full, AWS regenerates the files instead of appending to them, and the
+    fact table holds monthly totals that can't be topped up with a part of
+    a month. Nothing is recorded until commit(), once the graph ran
+    without failures().
+    """
+
+    def __init__(self, store, bucket=BILLING_BUCKET):
+        self.store = store
+        self.bucket = bucket
+        self.changed = {}
+        self.rows = {}
+        self.watched = []
+
+    def plan(self, keys):
+        """Return the keys of the files that changed since last loaded"""
+        client = boto3.client('s3')
+
+        for key in keys:
+            head = client.head_object(Bucket=self.bucket, Key=key)
+            etag, size = head['ETag'], head['ContentLength']
+            previous = self.store.get(key)
+
+            if previous and previous['etag'] == etag and \
+                    previous['size'] == size:
+                print("# Skipping unchanged %s" % key)
+                continue
+
+            self.changed[key] = (etag, size)
+
+        return [key for key in keys if key in self.changed]
+
+    def read(self, key, rows, size):
+        """on_done hook of the reader, the file isn't loaded yet"""
+        self.rows[key] = rows
+
+    def watch(self, *nodes):
+        """Nodes reading or loading the files, see failures()"""
+        self.watched.extend(nodes)
+
+    def failures(self, context):
+        """
+        Names of the nodes of an executed graph that failed, either dead or
+        watched with errors. The other nodes report the rows they skip as
+        errors, which doesn't mean anything went missing.
+        """
+        return [
+            node.name for node in context.nodes
+            if node.defunct or (node.wrapped in self.watched
+                                and dict(node.get_statistics())['err'])
+        ]
+
+    def commit(self):
+        """Record the changed files as loaded, after a successful run"""
+        for key, (etag, size) in self.changed.items():
+            self.store.set(
+                key,
+                etag=etag,
+                size=size,
+                row_count=self.rows.get(key))
+
+    def prune(self, cutoff):
+        """Forget about the files of months before cutoff"""
+        month = cutoff.strftime("%Y-%m")
+
+        stale = []
+        for source in self.store.sources():
+            match = BILLING_KEY_RE.match(source)
+            if match and match.group('month') < month:
+                stale.append(source)
+
+        self.store.forget(stale)
 
 
 @use_raw_input
@@ -59,30 +297,18 @@ def filter_summary(bag):
 
 def _lookup_sk(self, context, database):
     """Context processor to perform database lookups"""
-    yield {
-        'ctx':
+    yield from lookup_dimensions(
         context,
-        'session':
-        sessionmaker(bind=database)(),
-        'aws_accounts':
-        Table(
-            "dim_aws_accounts",
-            MetaData(),
-            autoload=True,
-            autoload_with=database),
-        'date':
-        Table("dim_date", MetaData(), autoload=True, autoload_with=database),
-    }
+        database,
+        aws_accounts=('dim_aws_accounts', 'linked_account_number'),
+        date=('dim_date', 'date'),
+    )
 
 
 @use('database')
 @use_context_processor(_lookup_sk)
 def lookup_account_sk(context, row, database):
-    session = context['session']
-    table = context['aws_accounts']
-
-    instance = session.query(table).filter_by(
-        linked_account_number=row['linkedaccountid']).one_or_none()
+    instance = context['aws_accounts'].get(row['linkedaccountid'])
     if instance and instance.account_name_key:
         return {
             **row,
@@ -90,18 +316,16 @@ def lookup_account_sk(context, row, database):
             'account_name': instance.account_name,
         }
     else:
-        print("XXX: Can't find account sk for %s" % row['account_name'])
+        print("XXX: Can't find account sk for %s" % row['linkedaccountid'])
         context['ctx'].error(
-            "Couldn't find account sk for %s" % row['account_name'], level=0)
+            "Couldn't find account sk for %s" % row['linkedaccountid'],
+            level=0)
 
 
 @use('database')
 @use_context_processor(_lookup_sk)
 def lookup_date_sk(context, row, database):
-    session = context['session']
-    table = context['date']
-
-    instance = session.query(table).filter_by(date=row['date']).one_or_none()
+    instance = context['date'].get(row['date'])
     if instance and instance.date_key:
         return {
             **row,
@@ -153,7 +377,8 @@ def fix_numbers(context, bag):
 
 @use_context
 @use_raw_input
-def parse_dates(context, bag):
+@use_context_processor(date_parsers)
+def parse_dates(parsers, context, bag):
 
     row = bag._asdict()
 
@@ -164,7 +389,7 @@ def parse_dates(context, bag):
 
     for key in keys:
         if "date" in key and row[key] != "":
-            parsed_date = dateparser.parse(row[key])
+            parsed_date = parsers[key](row[key])
             if parsed_date:
                 row[key] = parsed_date.date()
             else:
@@ -176,74 +401,267 @@ def parse_dates(context, bag):
     yield tuple(row.values())
 
 
-def _summarize_costs(self, context):
-    summary = {}
-    yield summary
+def _summary_rows(summary):
+    for (account, date, product), cost in summary.items():
+        yield {
+            'date_sk': date,
+            'productname': product,
+            'account_name_sk': account,
+            'total_cost': cost,
+        }
+
+
+@transformation_factory
+def SummarizeCosts(memory=None, sorted_input=False):
+    """
+    Sum up costs by account, date and product, holding at most memory MB of
+    sums before spilling to disk. With sorted_input, rows are promised to
+    come ordered by date, so each date is sent as soon as the next starts.
+    """
+
+    def _summarize_costs(self, context):
+        info = {
+            'summary': SumAccumulator(max_keys_for(memory)),
+            'date': None,
+        }
+        yield info
+
+        for row in _summary_rows(info['summary']):
+            context.send(row)
+
+    @use_context_processor(_summarize_costs)
+    def _SummarizeCosts(info, row):
+        summary = info['summary']
+        date = row['date_sk']
+
+        if sorted_input and summary and date != info['date']:
+            yield from _summary_rows(summary)
+
+        info['date'] = date
+        summary.add((row['account_name_sk'], date, row['productname']),
+                    float(row['total_cost']))
+
+    return _SummarizeCosts
+
+
+# Columnar mode, same as the above but on batches of rows stored column-wise,
+# which lets every check run once per column and every distinct date string
+# get parsed only once per batch.
+
+class ColumnBatch:
+    """A batch of rows, stored as one list of values per field"""
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, fields, rows):
+        for row in rows:
+            cls.check_row(fields, row)
+
+        return cls(
+            collections.OrderedDict(zip(fields, map(list, zip(*rows)))))
+
+    @staticmethod
+    def check_row(fields, row):
+        # zip() would silently truncate the columns to the shortest row
+        if len(row) != len(fields):
+            raise ValueError("Expected %d fields, got %d: %r" %
+                             (len(fields), len(row), row))
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    @property
+    def fields(self):
+        return list(self.columns.keys())
 
-    for account, dates in summary.items():
-        for date, products in dates.items():
-            for product, cost in products.items():
-                context.send({
-                    'date_sk': date,
-                    'productname': product,
-                    'account_name_sk': account,
-                    'total_cost': cost,
-                })
+    def column(self, field):
+        return self.columns.get(field, [None] * len(self))
 
+    def select(self, mask):
+        return ColumnBatch(
+            collections.OrderedDict(
+                (field, [value for value, keep in zip(column, mask) if keep])
+                for field, column in self.columns.items()))
 
-@use_context_processor(_summarize_costs)
-def summarize_costs(context, row):
-    info = context
+    def rows(self):
+        return zip(*self.columns.values())
 
-    account = row['account_name_sk']
-    if not account in info:
-        info[account] = {}
 
-    info = info[account]
+@transformation_factory
+def BatchRows(size=BATCH_SIZE):
+    def _batch_rows(self, context):
+        rows = yield []
 
-    date = row['date_sk']
-    if not date in info:
-        info[date] = {}
+        if rows:
+            context.send(ColumnBatch.from_rows(context.get_input_fields(), rows))
 
-    info = info[date]
+    @use_context
+    @use_raw_input
+    @use_context_processor(_batch_rows)
+    def _BatchRows(rows, context, bag):
+        # Rejected one by one, instead of failing the whole batch
+        ColumnBatch.check_row(context.get_input_fields(), bag)
+        rows.append(bag)
 
-    product = row['productname']
-    if not product in info:
-        info[product] = 0
+        if len(rows) >= size:
+            batch = ColumnBatch.from_rows(context.get_input_fields(), rows)
+            rows.clear()
+            yield batch
 
-    info[product] += float(row['total_cost'])
+    return _BatchRows
 
 
-def get_graph(**options):
+@use_context
+def invalid_entries_columnar(context, batch):
+    accounts = batch.column('linkedaccountid')
+    invoices = batch.column('invoicedate')
+
+    mask = [bool(account) for account in accounts]
+    if not all(mask):
+        context.error(
+            "Skipping %d rows without linked account id" % mask.count(False),
+            level=0)
+
+    missing = [keep and not invoice for keep, invoice in zip(mask, invoices)]
+    if any(missing):
+        context.error(
+            "Skipping %d rows without invoicedate" % missing.count(True),
+            level=0)
+        mask = [keep and not skip for keep, skip in zip(mask, missing)]
+
+    batch = batch.select(mask)
+    if len(batch):
+        yield batch
+
+
+def fix_numbers_columnar(batch):
+    # Fix numbrers, yuck
+    for field in ('blendedrate', 'rateid'):
+        if field in batch.columns:
+            batch.columns[field] = [
+                0 if value == "" else value
+                for value in batch.columns[field]
+            ]
+
+    return NOT_MODIFIED
+
+
+@use_context
+@use_context_processor(date_parsers)
+def parse_dates_columnar(parsers, context, batch):
+    mask = [True] * len(batch)
+
+    for field, column in batch.columns.items():
+        if "date" not in field:
+            continue
+
+        parsed = {"": ""}
+        for value in set(column):
+            if value in parsed:
+                continue
+            try:
+                parsed[value] = parsers[field](value).date()
+            except (ValueError, OverflowError):
+                context.error(
+                    "Could not parse date %s for key %s" % (value, field),
+                    level=0)
+                parsed[value] = None
+
+        batch.columns[field] = column = [parsed[value] for value in column]
+        mask = [keep and value is not None for keep, value in zip(mask, column)]
+
+    if not all(mask):
+        batch = batch.select(mask)
+
+    if len(batch):
+        yield batch
+
+
+def filter_summary_columnar(batch):
+    columns = batch.columns
+
+    for recordtype, total_cost, productname, date, linkedaccountid in zip(
+            columns['recordtype'], columns['totalcost'],
+            columns['productname'], columns['billingperiodenddate'],
+            columns['linkedaccountid']):
+        if recordtype == 'LinkedLineItem':
+            yield {
+                'total_cost': total_cost,
+                'productname': productname,
+                'date': date,
+                'linkedaccountid': linkedaccountid,
+            }
+
+
+@use_context
+def unbatch(context, batch):
+    if not context.output_type:
+        context.set_output_fields(batch.fields)
+
+    yield from batch.rows()
+
+
+def get_graph(state=None, **options):
     """
     This function builds the graph that needs to be executed.
 
+    :param state: BillingState, to only read billing files that changed
     :return: bonobo.Graph
 
     """
     graph = bonobo.Graph()
 
-    graph.add_chain(
+    fact_loader = BulkInsertOrUpdate(
+        table_name='fact_itsm_aws_historical_cost'  + options['table_suffix'],
+        discriminant=(
+            'productname',
+            'date_sk',
+            'account_name_sk',
+        ),
+        engine='database')
+    ods_loader = BulkInsertOrUpdate(
+        table_name=options['table']  + options['table_suffix'],
+        discriminant=('invoiceid', 'linkedaccountid', 'payeraccountid',
+                      'recordid'),
+        engine='database')
+
+    writers = (
         bonobo.CsvWriter('billing.csv'),
         bonobo.JsonWriter('billing.json'),
-        invalid_entries,
-        fix_numbers,
-        parse_dates,
-        #bonobo.PrettyPrinter(),
-        filter_summary,
-        #bonobo.PrettyPrinter(),
+    )
+
+    if options['columnar']:
+        clean = (
+            *writers,
+            BatchRows(),
+            invalid_entries_columnar,
+            fix_numbers_columnar,
+            parse_dates_columnar,
+        )
+        summary, ods = filter_summary_columnar, (unbatch, )
+    else:
+        clean = (
+            *writers,
+            invalid_entries,
+            fix_numbers,
+            parse_dates,
+        )
+        summary, ods = filter_summary, ()
+
+    graph.add_chain(
+        *clean,
+        summary,
         lookup_account_sk,
         lookup_date_sk,
-        summarize_costs,
+        SummarizeCosts(
+            memory=options['summary_memory'],
+            sorted_input=options['sorted_input']),
         bonobo.UnpackItems(0),
-        bonobo_sqlalchemy.InsertOrUpdate(
-            table_name='fact_itsm_aws_historical_cost'  + options['table_suffix'],
-            discriminant=(
-                'productname',
-                'date_sk',
-                'account_name_sk',
-            ),
-            engine='database'),
+        fact_loader,
         _name="main",
         _input=None,
     )
@@ -253,35 +671,54 @@ def get_graph(**options):
     # Go to beginning of month
     now += relativedelta(day=1, hour=0, minute=0, second=0, microsecond=0)
 
+    keys = []
     when = now
     for log in range(0, options['months']):
         when = when + relativedelta(months=-1)
         tstamp = when.strftime("%Y-%m")
         print("# %d Processing %s" % (log, tstamp))
+        keys.append(
+            BILLING_KEY.format(
+                account=options['aws_account_id'], month=tstamp))
+
+    readers, on_done = [], None
+    if state:
+        keys = state.plan(keys)
+        on_done = state.read
+
+    if not keys:
+        print("# Nothing to do")
+    elif options['workers']:
+        readers.append(
+            AwsBillingMonthsReader(
+                keys,
+                workers=options['workers'],
+                limit=options['limit'],
+                on_done=on_done))
+        graph.add_chain(readers[-1], _output="main")
+    else:
         if options['limit']:
             _limit = (bonobo.Limit(options['limit']), )
         else:
             _limit = ()
 
-        graph.add_chain(
-            AwsBillingReader(
-                '%s-aws-cost-allocation-%s.csv' % (options['aws_account_id'],
-                                                   tstamp),
-                fs='s3',
-                skip=1),
-            *_limit,
-            _output="main",
-        )
+        for key in keys:
+            readers.append(AwsBillingReader(key, fs='s3', skip=1))
+            graph.add_chain(
+                readers[-1],
+                *_limit,
+                _output="main",
+            )
 
     graph.add_chain(
-        bonobo_sqlalchemy.InsertOrUpdate(
-            table_name=options['table']  + options['table_suffix'],
-            discriminant=('invoiceid', 'linkedaccountid', 'payeraccountid',
-                          'recordid'),
-            engine='database'),
-        _input=parse_dates,
+        *ods,
+        ods_loader,
+        _input=clean[-1],
     )
 
+    if state:
+        state.watch(fact_loader, ods_loader, *readers)
+
     return graph
 
 
@@ -300,7 +737,7 @@ def get_services(**options):
         'mysql':
         create_engine('mysql+mysqldb://localhost/aws', echo=False),
         's3':
-        bonobo.open_fs('s3://mozilla-programmatic-billing'),
+        bonobo.open_fs('s3://' + BILLING_BUCKET),
         'redshift':
         create_engine(
             'redshift+psycopg2://etl_edw@mozit-dw-dev.czbv3z9khmhv.us-west-2.redshift.amazonaws.com/edw-dev-v1',
@@ -316,6 +753,12 @@ def get_services(**options):
 
     services['database'] = services[options['database']]
 
+    # Either one of the engines above, or its own DSN (sqlite for local runs)
+    if options['state_dsn'] in services:
+        services['state'] = services[options['state_dsn']]
+    else:
+        services['state'] = create_engine(options['state_dsn'], echo=False)
+
     return services
 
 
@@ -333,7 +776,7 @@ def valid_date(s):
         raise argparse.ArgumentTypeError(msg)
 
 
-def cleanup(engine, now, months, table):
+def cleanup(engine, now, months, table, state=None, swap_fraction=None):
     # Duplicated logic from above
     cutoff = now + relativedelta(
         day=1, hour=0, minute=0, second=0, microsecond=0)
@@ -341,17 +784,39 @@ def cleanup(engine, now, months, table):
     for log in range(0, months):
         cutoff = cutoff + relativedelta(months=-1)
 
-    with engine.connect() as connection:
-        res = connection.execute(
-            "SELECT count(1) from %s where invoicedate < '%s'" %
-            (table, cutoff.date()))
-        print(
-            "# Cleanup %s rows at %s" % (res.fetchall()[0][0], cutoff.date()))
-        res = connection.execute(
-            "DELETE from %s where invoicedate < '%s'" % (table, cutoff.date()))
+    options = {}
+    if swap_fraction is not None:
+        options['swap_fraction'] = swap_fraction
+
+    apply_retention(engine, table, 'invoicedate', cutoff, **options)
+
+    if state:
+        state.prune(cutoff)
 
 
 if __name__ == '__main__':
+    if not __package__:
+        from os import sys, path
+        top = path.dirname(
+            path.dirname(path.dirname(path.dirname(path.abspath(__file__)))))
+        sys.path.append(top)
+
+        me = []
+        me.append(path.split(path.dirname(path.abspath(__file__)))[1])
+        me.insert(
+            0,
+            path.split(path.dirname(path.dirname(path.abspath(__file__))))[1])
+        me.insert(
+            0,
+            path.split(
+                path.dirname(
+                    path.dirname(path.dirname(path.abspath(__file__)))))[1])
+
+        __package__ = '.'.join(me)
+
+    from ... import (BulkInsertOrUpdate, SourceStateStore, SumAccumulator,
+                     apply_retention, lookup_dimensions, max_keys_for)
+
     parser = bonobo.get_argument_parser()
 
     VERTICA_DSN = "vertica+vertica_python://{username}:{password}@{host}:5433/metrics"
@@ -362,11 +827,47 @@ if __name__ == '__main__':
         '--aws_account_id', type=int, default=get_aws_account_id())
     parser.add_argument('--months', type=int, default=2)
     parser.add_argument('--limit', type=int, default=False)
+    parser.add_argument(
+        '--columnar',
+        action='store_true',
+        default=False,
+        help='Validate and transform billing rows by batches of columns')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='Parse billing files in this many processes, streamed from S3 '
+        'instead of read in-process')
+    parser.add_argument(
+        '--summary-memory',
+        type=int,
+        default=None,
+        help='MB of cost sums to hold before spilling them to disk')
+    parser.add_argument(
+        '--sorted-input',
+        action='store_true',
+        default=False,
+        help='Billing rows come ordered by date, send sums date by date')
     parser.add_argument(
         '--table', type=str, default='ods_itsm_aws_monthly_cost')
     parser.add_argument('--cleanup', dest='cleanup', action='store_true')
     parser.add_argument('--no-cleanup', dest='cleanup', action='store_false')
     parser.set_defaults(cleanup=True)
+    parser.add_argument(
+        '--swap-fraction',
+        type=float,
+        default=None,
+        help='Rebuild the table instead of deleting past this expired ratio')
+    parser.add_argument(
+        '--incremental', dest='incremental', action='store_true')
+    parser.add_argument(
+        '--no-incremental', dest='incremental', action='store_false')
+    parser.set_defaults(incremental=True)
+    parser.add_argument(
+        '--state-dsn',
+        type=str,
+        default=os.getenv('BOOMI_STATE_DSN', 'sqlite:///etl_state.sqlite'),
+        help='Where to track loaded billing files, a DSN or "database"')
     parser.add_argument('--vertica-username', type=str, default='tableau')
     parser.add_argument('--vertica-password', type=str, default=False)
     parser.add_argument(
@@ -384,6 +885,29 @@ if __name__ == '__main__':
     with bonobo.parse_args(parser) as opt:
         svcs = get_services(**opt)
 
-        bonobo.run(get_graph(**opt), services=svcs)
+        state = None
+        if opt['incremental']:
+            # Files loaded into another engine or table don't count
+            state = BillingState(
+                SourceStateStore(
+                    svcs['state'], '%s:%s%s' % (opt['database'], opt['table'],
+                                                opt['table_suffix'])))
+
+        context = bonobo.run(get_graph(state=state, **opt), services=svcs)
+
+        # Loaders flush as they stop, a file is loaded once the run is over
+        if state and not opt['limit']:
+            failed = state.failures(context)
+            if failed:
+                print("# Not recording loaded billing files, errors in %s" %
+                      ', '.join(failed))
+            else:
+                state.commit()
         if opt['cleanup']:
-            cleanup(svcs['database'], opt['now'], opt['months'], opt['table'])
+            cleanup(
+                svcs['database'],
+                opt['now'],
+                opt['months'],
+                opt['table'],
+                state=state,
+                swap_fraction=opt['swap_fraction'])
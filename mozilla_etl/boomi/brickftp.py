@@ -0,0 +1,86 @@
+import paramiko
+from fs import errors
+from fs.mode import Mode
+from fs.sshfs import SSHFS
+from fs.sshfs.error_tools import convert_sshfs_errors
+from fs.sshfs.file import SSHFile
+
+# Bytes written per SFTP request batch, instead of paramiko's 8kB
+BUFFER_SIZE = 1024 * 1024
+
+# SSH channel window, large enough to keep the pipe full over the ocean
+WINDOW_SIZE = 16 * 1024 * 1024
+
+
+class BrickFTPFS(SSHFS):
+    """
+    SSHFS tuned for bulk transfers with BrickFTP.
+
+    All files are opened on a single SFTP channel with a large window.
+    Writes are buffered buffer_size bytes at a time and pipelined (not
+    waiting for each write to be acknowledged), files opened for reading
+    only are prefetched (all their blocks are requested at once, instead
+    of one round trip per read).
+
+    Registered as a lazy service, a single connection serves all the files
+    of a job and all its bonobo.run() calls. It is opened again if the
+    server dropped it in between, which is checked before each operation
+    (opening a file, listing a directory, ...): a connection lost in the
+    middle of a transfer still fails it.
+    """
+
+    def __init__(self, host, user=None, buffer_size=BUFFER_SIZE,
+                 window_size=WINDOW_SIZE, **kwargs):
+        self._connect_args = (host, user, kwargs)
+        self.buffer_size = buffer_size
+        self.window_size = window_size
+
+        super().__init__(host, user=user, **kwargs)
+
+        self._open_sftp()
+
+        # Bug workaround to brickftp's sftp-only server
+        self._platform = "Linux"
+
+    def _open_sftp(self):
+        self._sftp.close()
+        self._sftp = paramiko.SFTPClient.from_transport(
+            self._client.get_transport(), window_size=self.window_size)
+
+    def check(self):
+        super().check()
+
+        transport = self._client.get_transport()
+        if transport is None or not transport.is_active():
+            host, user, kwargs = self._connect_args
+            # Kept around, it closes its client once garbage collected
+            self._connection = SSHFS(host, user=user, **kwargs)
+            self._client = self._connection._client
+            self._sftp = self._connection._sftp
+            self._open_sftp()
+
+    def openbin(self, path, mode='r', buffering=-1, **options):
+        # Same as SSHFS.openbin, on our own channel
+        self.check()
+        _path = self.validatepath(path)
+        _mode = Mode(mode)
+        _mode.validate_bin()
+
+        if buffering == -1:
+            buffering = self.buffer_size
+
+        with self._lock:
+            if _mode.exclusive and self.exists(_path):
+                raise errors.FileExists(path)
+            elif _mode.reading and not _mode.create and \
+                    not self.exists(_path):
+                raise errors.ResourceNotFound(path)
+            elif self.isdir(_path):
+                raise errors.FileExpected(path)
+            with convert_sshfs_errors('openbin', path):
+                handle = self._sftp.open(
+                    _path, mode=_mode.to_platform_bin(), bufsize=buffering)
+                handle.set_pipelined(True)
+                if _mode.reading and not _mode.writing:
+                    handle.prefetch()
+                return SSHFile(handle)
@@ -0,0 +1,372 @@
+import collections
+import concurrent.futures
+import datetime
+import gzip
+import logging
+import os
+import tempfile
+
+from sqlalchemy import MetaData, Table, and_, exists, select, text
+from sqlalchemy.exc import OperationalError
+
+from bonobo.config import Configurable, ContextProcessor, Option, Service, use_context, use_raw_input
+from bonobo.errors import UnrecoverableError
+
+logger = logging.getLogger(__name__)
+
+# How rows are moved into the staging table, per database flavour
+COPY_POSTGRES = "COPY {stage} ({columns}) FROM STDIN WITH CSV"
+COPY_VERTICA = "COPY {stage} ({columns}) FROM STDIN GZIP DELIMITER ',' ENCLOSED BY '\"' NULL '' ABORT ON ERROR"
+COPY_REDSHIFT = "COPY {stage} ({columns}) FROM '{url}' CREDENTIALS '{credentials}' GZIP CSV EMPTYASNULL"
+
+STAGE_DDL = {
+    'vertica':
+    'CREATE LOCAL TEMPORARY TABLE {stage} ON COMMIT PRESERVE ROWS AS SELECT * FROM {table} LIMIT 0',
+    'default':
+    'CREATE TEMPORARY TABLE {stage} AS SELECT * FROM {table} WHERE 1 = 0',
+}
+
+# Rows per multi-VALUES INSERT when we can't COPY into the staging table
+INSERT_CHUNK_SIZE = 500
+
+
+def _csv_field(value):
+    # Unquoted empty is NULL, quoted empty is the empty string, for all of
+    # postgres, redshift and vertica CSV loaders.
+    if value is None:
+        return ''
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def get_flavour(connection):
+    """Figure out which bulk loading strategy a connection supports"""
+    name = connection.dialect.name
+
+    if name == 'postgresql':
+        # Our redshift DSN defaults to the plain postgresql dialect
+        version = connection.execute(text('SELECT version()')).scalar()
+        if 'redshift' in version.lower():
+            return 'redshift'
+
+    return name
+
+
+@use_context
+@use_raw_input
+class BulkInsertOrUpdate(Configurable):
+    """
+    Drop-in replacement for bonobo_sqlalchemy.InsertOrUpdate that loads rows in
+    bulk instead of doing a SELECT then INSERT/UPDATE for every single row.
+
+    Rows are buffered (deduplicated on the discriminant, last one wins), staged
+    into a temporary table using the fastest method the database offers (COPY
+    for postgres and redshift, COPY FROM STDIN for vertica, multi-row INSERTs
+    otherwise), then merged into the target table with one UPDATE of the rows
+    already there and one INSERT ... SELECT of the new ones, keyed on the
+    discriminant.
+
+    As with InsertOrUpdate, only the columns a row has are written, existing
+    rows keep their other columns and their created_at. Rows of a batch with
+    different columns are merged separately.
+
+    Unlike InsertOrUpdate, nothing is sent downstream.
+    """
+    table_name = Option(str, positional=True)  # type: str
+    discriminant = Option(tuple, required=False, default=('id', ))  # type: tuple
+    created_at_field = Option(str, required=False, default='created_at')  # type: str
+    updated_at_field = Option(str, required=False, default='updated_at')  # type: str
+    buffer_size = Option(int, required=False, default=50000)  # type: int
+
+    # Redshift can only COPY from S3, leave unset to load with INSERTs instead
+    s3_stage = Option(str, required=False, default=None)  # type: str
+    s3_credentials = Option(str, required=False, default=None)  # type: str
+
+    engine = Service('sqlalchemy.engine')  # type: str
+
+    @ContextProcessor
+    def create_connection(self, context, *, engine):
+        try:
+            connection = engine.connect()
+        except OperationalError as exc:
+            raise UnrecoverableError(
+                'Could not create SQLAlchemy connection: {}.'.format(
+                    str(exc).replace('\n', ''))) from exc
+
+        with connection:
+            yield connection
+
+    @ContextProcessor
+    def create_table(self, context, connection, *, engine):
+        yield Table(
+            self.table_name, MetaData(), autoload=True, autoload_with=engine)
+
+    @ContextProcessor
+    def create_buffer(self, context, connection, table, *, engine):
+        buffer = yield {}
+
+        try:
+            self.commit(connection, table, buffer, force=True)
+        except Exception as exc:
+            logger.exception('Flush fail')
+            raise UnrecoverableError('Flushing bulk load failed.') from exc
+
+    def __call__(self, connection, table, buffer, context, row, engine):
+        try:
+            row = row._asdict()
+        except AttributeError:
+            row = dict(row)
+
+        key = tuple(row.get(col) for col in self.discriminant)
+        buffer[key] = row
+
+        self.commit(connection, table, buffer)
+
+    def commit(self, connection, table, buffer, force=False):
+        if not buffer or not (force or len(buffer) >= self.buffer_size):
+            return
+
+        rows = list(buffer.values())
+        buffer.clear()
+
+        now = datetime.datetime.now()
+        column_names = table.columns.keys()
+        for row in rows:
+            for field in (self.created_at_field, self.updated_at_field):
+                if field in column_names:
+                    row[field] = now
+
+        # Missing columns must be left alone, not merged as NULLs
+        groups = collections.OrderedDict()
+        for row in rows:
+            columns = tuple(col for col in column_names if col in row)
+            groups.setdefault(columns, []).append(row)
+
+        flavour = get_flavour(connection)
+        stage_name = 'stage_' + self.table_name
+
+        with connection.begin():
+            connection.execute(
+                text(
+                    STAGE_DDL.get(flavour, STAGE_DDL['default']).format(
+                        stage=stage_name, table=self.table_name)))
+            stage = Table(stage_name, MetaData(),
+                          *(col.copy() for col in table.columns))
+
+            for columns, group in groups.items():
+                self.stage(flavour, connection, stage, columns, group)
+                self.merge(flavour, connection, table, stage, columns)
+                connection.execute(stage.delete())
+
+            connection.execute(text('DROP TABLE ' + stage_name))
+
+        logger.info('Bulk loaded %d rows into %s', len(rows), self.table_name)
+
+    def stage(self, flavour, connection, stage, columns, rows):
+        if flavour == 'redshift' and not self.s3_stage:
+            return self.stage_with_inserts(
+                connection, stage, columns, rows, chunk=INSERT_CHUNK_SIZE)
+
+        if flavour not in ('postgresql', 'redshift', 'vertica'):
+            return self.stage_with_inserts(connection, stage, columns, rows)
+
+        fd, path = tempfile.mkstemp(suffix='.csv.gz')
+        os.close(fd)
+
+        try:
+            with gzip.open(path, 'wt', encoding='utf-8', newline='') as file:
+                for row in rows:
+                    file.write(','.join(
+                        _csv_field(row.get(col)) for col in columns) + '\n')
+
+            sql = {
+                'postgresql': COPY_POSTGRES,
+                'redshift': COPY_REDSHIFT,
+                'vertica': COPY_VERTICA,
+            }[flavour].format(
+                stage=stage.name,
+                columns=', '.join(columns),
+                url=self.s3_stage,
+                credentials=self.s3_credentials)
+
+            cursor = connection.connection.cursor()
+            try:
+                if flavour == 'postgresql':
+                    with gzip.open(path, 'rt', encoding='utf-8') as file:
+                        cursor.copy_expert(sql, file)
+                elif flavour == 'vertica':
+                    with open(path, 'rb') as file:
+                        cursor.copy(sql, file)
+                else:
+                    self.upload_to_s3(path)
+                    cursor.execute(sql)
+            finally:
+                cursor.close()
+        finally:
+            os.unlink(path)
+
+    def stage_with_inserts(self, connection, stage, columns, rows, chunk=None):
+        values = [{col: row.get(col) for col in columns} for row in rows]
+
+        if not chunk:
+            connection.execute(stage.insert(), values)
+            return
+
+        for i in range(0, len(values), chunk):
+            connection.execute(stage.insert().values(values[i:i + chunk]))
+
+    def upload_to_s3(self, path):
+        import boto3
+
+        bucket, _, key = self.s3_stage[len('s3://'):].partition('/')
+        boto3.client('s3').upload_file(path, bucket, key)
+
+    def merge(self, flavour, connection, table, stage, columns):
+        match = and_(*(getattr(table.c, col) == getattr(stage.c, col)
+                       for col in self.discriminant))
+
+        updated = [
+            col for col in columns
+            if col not in self.discriminant and col != self.created_at_field
+        ]
+        if updated:
+            if flavour in ('postgresql', 'redshift', 'vertica', 'mysql'):
+                update = table.update().where(match).values(
+                    {col: getattr(stage.c, col)
+                     for col in updated})
+            else:
+                # No UPDATE ... FROM, one correlated subquery per column
+                update = table.update().where(exists().where(match)).values({
+                    col: select([getattr(stage.c, col)]).where(match).as_scalar()
+                    for col in updated
+                })
+            connection.execute(update)
+
+        connection.execute(table.insert().from_select(
+            columns,
+            select([getattr(stage.c, col) for col in columns]).where(
+                ~exists().where(match))))
+
+
+@use_context
+@use_raw_input
+class FanOutInsertOrUpdate(Configurable):
+    """
+    BulkInsertOrUpdate into several engines at once.
+
+    Rows are buffered a single time, then each full buffer is loaded into all
+    the engines (named by their service) concurrently, one thread and one
+    connection per engine. An engine failing does not stop the others, it is
+    left out of the following batches, and the run fails at the end with the
+    per-engine success and failure counts.
+
+    Nothing is sent downstream.
+    """
+    table_name = Option(str, positional=True)  # type: str
+    engines = Option(tuple, required=True)  # type: tuple
+    discriminant = Option(tuple, required=False, default=('id', ))  # type: tuple
+    created_at_field = Option(str, required=False, default='created_at')  # type: str
+    updated_at_field = Option(str, required=False, default='updated_at')  # type: str
+    buffer_size = Option(int, required=False, default=50000)  # type: int
+    s3_stage = Option(str, required=False, default=None)  # type: str
+    s3_credentials = Option(str, required=False, default=None)  # type: str
+
+    @ContextProcessor
+    def create_targets(self, context):
+        targets = collections.OrderedDict()
+        for name in self.engines:
+            targets.setdefault(name, {
+                'loader': BulkInsertOrUpdate(
+                    self.table_name,
+                    discriminant=self.discriminant,
+                    created_at_field=self.created_at_field,
+                    updated_at_field=self.updated_at_field,
+                    s3_stage=self.s3_stage,
+                    s3_credentials=self.s3_credentials,
+                    engine=name),
+                'engine': name,
+                'connection': None,
+                'table': None,
+                'rows': 0,
+                'batches': 0,
+                'error': None,
+            })
+
+        try:
+            yield targets
+        finally:
+            for target in targets.values():
+                if target['connection'] is not None:
+                    target['connection'].close()
+
+        for name, target in targets.items():
+            print("# %s into %s: %d rows in %d batches%s" %
+                  (self.table_name, name, target['rows'], target['batches'],
+                   ', failed: %s' % target['error']
+                   if target['error'] else ''))
+
+        failed = [name for name, target in targets.items() if target['error']]
+        if failed:
+            raise UnrecoverableError('Bulk load into {} failed for {}.'.format(
+                self.table_name, ', '.join(failed)))
+
+    @ContextProcessor
+    def create_pool(self, context, targets):
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(targets) or 1) as pool:
+            yield pool
+
+    @ContextProcessor
+    def create_buffer(self, context, targets, pool):
+        buffer = yield {}
+
+        self.commit(context, pool, targets, buffer, force=True)
+
+    def __call__(self, targets, pool, buffer, context, row):
+        try:
+            row = row._asdict()
+        except AttributeError:
+            row = dict(row)
+
+        key = tuple(row.get(col) for col in self.discriminant)
+        buffer[key] = row
+
+        self.commit(context, pool, targets, buffer)
+
+    def commit(self, context, pool, targets, buffer, force=False):
+        if not buffer or not (force or len(buffer) >= self.buffer_size):
+            return
+
+        rows = list(buffer.values())
+        buffer.clear()
+
+        pending = {
+            name: pool.submit(self.load, context, target, rows)
+            for name, target in targets.items() if not target['error']
+        }
+
+        for name, future in pending.items():
+            target = targets[name]
+            try:
+                future.result()
+            except Exception as exc:
+                logger.exception('Bulk load into %s failed', name)
+                target['error'] = '{}: {}'.format(
+                    type(exc).__name__, str(exc).replace('\n', ' '))
+            else:
+                target['rows'] += len(rows)
+                target['batches'] += 1
+
+    def load(self, context, target, rows):
+        if target['connection'] is None:
+            engine = context.get_service(target['engine'])
+            target['connection'] = engine.connect()
+            target['table'] = Table(
+                self.table_name,
+                MetaData(),
+                autoload=True,
+                autoload_with=engine)
+
+        # Each engine gets its own copies, commit() stamps them
+        buffer = {i: dict(row) for i, row in enumerate(rows)}
+        target['loader'].commit(
+            target['connection'], target['table'], buffer, force=True)
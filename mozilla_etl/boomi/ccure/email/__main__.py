@@ -1,5 +1,4 @@
 import bonobo
-import bonobo_sqlalchemy
 import os
 
 from bonobo.config import use, use_context, use_raw_input, use_context_processor
@@ -83,14 +82,12 @@ def get_graph(**options):
             '/etl/metrics-insights/workday-users.csv', fs='brickftp'),
         employee_active, find_badge_id, bonobo.UnpackItems(0), split_dbs)
 
-    for engine in list(set(options['engine'])):
-        graph.add_chain(
-            bonobo_sqlalchemy.InsertOrUpdate(
-                table_name=options['table_name'] + options['table_suffix'],
-                discriminant=('badgeid', ),
-                buffer_size=10,
-                engine=engine),
-            _input=split_dbs)
+    graph.add_chain(
+        FanOutInsertOrUpdate(
+            table_name=options['table_name'] + options['table_suffix'],
+            discriminant=('badgeid', ),
+            engines=options['engine']),
+        _input=split_dbs)
 
     return graph
 
@@ -206,7 +203,7 @@ if __name__ == '__main__':
 
         __package__ = '.'.join(me)
 
-    from ... import add_default_arguments, add_default_services
+    from ... import add_default_arguments, add_default_services, default_plugins, FanOutInsertOrUpdate
 
     parser = bonobo.get_argument_parser()
 
@@ -223,8 +220,8 @@ if __name__ == '__main__':
 
         g1 = get_cache_graph(**options)
         print("# Running card_id cache")
-        bonobo.run(g1, services=services)
+        bonobo.run(g1, services=services, plugins=default_plugins(services))
 
         g2 = get_graph(**options)
         print("# Runing employee mapping")
-        bonobo.run(g2, services=services)
+        bonobo.run(g2, services=services, plugins=default_plugins(services))
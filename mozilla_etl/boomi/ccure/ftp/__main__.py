@@ -1,14 +1,17 @@
 import bonobo
-import bonobo_sqlalchemy
 import os
 
-from dateutil import parser as dateparser
+from bonobo.config import use_context_processor
+
+from mozilla_etl.boomi.dates import date_parsers
 
 import re
 
 
-def timestamp(admitted, blank1, timestamp, blank2, name, card_id, location):
-    parsed_date = dateparser.parse(timestamp)
+@use_context_processor(date_parsers)
+def timestamp(parsers, admitted, blank1, timestamp, blank2, name, card_id,
+              location):
+    parsed_date = parsers['timestamp'](timestamp)
 
     yield (admitted, blank1, parsed_date, blank2, name, card_id, location)
 
@@ -55,18 +58,17 @@ def get_graph(**options):
         split_dbs,
         _name="main")
 
-    for engine in list(set(options['engine'])):
-        graph.add_chain(
-            bonobo_sqlalchemy.InsertOrUpdate(
-                table_name=options['table_name'] + options['table_suffix'],
-                discriminant=(
-                    'activitydate',
-                    'badgeid',
-                    'username',
-                    'location',
-                ),
-                engine=engine),
-            _input=split_dbs)
+    graph.add_chain(
+        FanOutInsertOrUpdate(
+            table_name=options['table_name'] + options['table_suffix'],
+            discriminant=(
+                'activitydate',
+                'badgeid',
+                'username',
+                'location',
+            ),
+            engines=options['engine']),
+        _input=split_dbs)
 
     return graph
 
@@ -106,7 +108,7 @@ if __name__ == '__main__':
 
         __package__ = '.'.join(me)
 
-    from ... import add_default_arguments, add_default_services
+    from ... import add_default_arguments, add_default_services, default_plugins, FanOutInsertOrUpdate
 
     parser = bonobo.get_argument_parser()
 
@@ -126,4 +128,7 @@ if __name__ == '__main__':
     with bonobo.parse_args(parser) as options:
         services = get_services(**options)
         add_default_services(services, options)
-        bonobo.run(get_graph(**options), services=services)
+        bonobo.run(
+            get_graph(**options),
+            services=services,
+            plugins=default_plugins(services))
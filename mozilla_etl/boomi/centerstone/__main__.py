@@ -2,12 +2,14 @@ import bonobo
 import bonobo_sqlalchemy
 import os
 
-from bonobo.config import Service, use, use_no_input, use_context, use_context_processor
+from bonobo.config import Configurable, ContextProcessor, Option, Service, use, use_no_input, use_context, use_context_processor
 from bonobo.config.functools import transformation_factory
 from bonobo.constants import NOT_MODIFIED
 
 from dateutil import parser as dateparser
 
+from sqlalchemy import create_engine
+
 import re
 import io
 import csv
@@ -23,6 +25,12 @@ import pprint
 import fs
 import datetime
 
+import collections
+import concurrent.futures
+import sys
+import threading
+import time
+
 from zeep import Client
 from zeep.wsse.username import UsernameToken
 import zeep.exceptions
@@ -43,33 +51,11 @@ OFFICE_IDS = {
 
 WORKDAY_BASE_URL = 'https://wd2-impl-services1.workday.com/'
 WORKDAY_API_VERSION = 'v26.0'
-WD_DESK_ID_QUERY = 'ccx/service/customreport2/{tenant}/ISU_RAAS/WPR_Worker_Space_Number?format=csv'
-
-_cache = {
-    'wpr': {},
-}
-
-
-def cache(self, context):
-    yield _cache
-
-
-import re
-
+# Columns of centerstone_updates.csv
+REPORT_FIELDS = ('EmployeeID', 'First_Name', 'Last_Name', 'Old_Desk_Number',
+                 'New_Desk_Number', 'Error', 'Status')
 
-@use_context_processor(cache)
-def cache_wpr(cache, row):
-    wpr_cache = cache['wpr']
-
-    if row['Employee_ID'] not in wpr_cache:
-        wpr_cache[row['Employee_ID']] = row
-    else:
-        yield {
-            "error":
-            "Employee %s has more than one record!" % row['Employee_ID']
-        }
-
-    return NOT_MODIFIED
+WD_DESK_ID_QUERY = 'ccx/service/customreport2/{tenant}/ISU_RAAS/WPR_Worker_Space_Number?format=csv'
 
 
 @use('workday')
@@ -77,35 +63,8 @@ def cache_wpr(cache, row):
 @use('workday_tenant')
 def get_wd_desk_ids(workday, workday_url, workday_tenant):
     """Retrieve Business Units from WorkDay"""
-    resp = workday.get(workday_url +
-                       WD_DESK_ID_QUERY.format(tenant=workday_tenant))
-
-    print('%r' % resp)
-
-    stream = io.StringIO(resp.content.decode("utf-8-sig"))
-
-    data = csv.reader(stream)
-
-    headers = next(data)
-
-    for row in data:
-        yield dict(zip(headers, row))
-
-
-def get_wd_graph(**options):
-    """
-    This function builds the graph that needs to be executed.
-
-    :return: bonobo.Graph
-
-    """
-    graph = bonobo.Graph()
-
-    split_dbs = bonobo.noop
-
-    graph.add_chain(get_wd_desk_ids, cache_wpr, _name="main")
-
-    return graph
+    yield from read_report(
+        workday, workday_url + WD_DESK_ID_QUERY.format(tenant=workday_tenant))
 
 
 def split_tabs(row):
@@ -121,10 +80,9 @@ def mismatch(row):
         return NOT_MODIFIED
 
 
-def join_wpr(row):
-    if row['EmployeeID'] in _cache['wpr']:
-        row['wpr'] = _cache['wpr'].get(row['EmployeeID'])
-        yield row
+def in_sync(row):
+    if row['wpr']['WPR_Desk_Number'] == row['SeatID']:
+        return NOT_MODIFIED
 
 
 def prefix_desk_ids(row):
@@ -151,85 +109,165 @@ def odd_employee(*args):
     return not (temp_employee(*args) or regular_employee(*args))
 
 
-#factory = wsdl_client.type_factory('bsvc')
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart, across threads"""
 
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
 
-@use('workday_soap')
-def update_employee_record(row, workday_soap):
-    factory = workday_soap.type_factory('bsvc')
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
 
-    employee_type = None
+        if delay > 0:
+            time.sleep(delay)
 
-    if row['wpr']['Worker_Type'] == "Contingent Worker":
-        employee_type = "Contingent_Worker_ID"
-    else:
-        employee_type = "Employee_ID"
 
-    print("XXX: [%s] Updating seat %s to %s for %s %s" %
-          (row['EmployeeID'], row['wpr']['WPR_Desk_Number'], row['SeatID'],
-           row['wpr']['First_Name'], row['wpr']['Last_Name']))
+@use_context
+class UpdateEmployeeRecords(Configurable):
+    """
+    Set the desk ID of mismatched workers in Workday with Change_Other_IDs,
+    calling it from a pool of workers, at most rate_limit times a second.
 
-    bus_param = factory.Business_Process_ParametersType(
-        Auto_Complete=True, Run_Now=True)
+    Sends one outcome per worker downstream: updated, nothing to do (the
+    known empty SOAP body bug), or failed with the fault. Outcomes keep the
+    snapshot digest of their row, if any.
+    """
+    workers = Option(int, required=False, default=4)  # type: int
+    rate_limit = Option(float, required=False, default=5.0)  # type: float
+
+    workday_soap = Service('workday_soap')  # type: str
+
+    @ContextProcessor
+    def create_pool(self, context, *, workday_soap):
+        factory = workday_soap.type_factory('bsvc')
+
+        # The same for every call, only build them once
+        static = {
+            'bus_param':
+            factory.Business_Process_ParametersType(
+                Auto_Complete=True, Run_Now=True),
+            'type_ref_primary':
+            factory.Custom_ID_TypeObjectType(ID=[
+                factory.Custom_ID_TypeObjectIDType(
+                    "CUSTOM_ID_TYPE-3-24",
+                    factory.Custom_ID_TypeReferenceEnumeration(
+                        "Custom_ID_Type_ID"))
+            ]),
+        }
 
-    custom_id_type_primary = factory.Custom_ID_TypeObjectIDType(
-        "CUSTOM_ID_TYPE-3-24",
-        factory.Custom_ID_TypeReferenceEnumeration("Custom_ID_Type_ID"))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as pool:
+            updates = yield {
+                'pool': pool,
+                'pending': collections.deque(),
+                'factory': factory,
+                'static': static,
+                'limiter': RateLimiter(self.rate_limit),
+                'outcomes': collections.Counter(),
+            }
 
-    type_ref_primary = factory.Custom_ID_TypeObjectType(
-        ID=[custom_id_type_primary])
+            for outcome in self.collect(
+                    context, updates, wait=len(updates['pending'])):
+                context.send(outcome)
 
-    custom_id_data_primary = factory.Custom_ID_DataType(
-        ID=row['SeatID'],
-        ID_Type_Reference=type_ref_primary,
-        Issued_Date=datetime.datetime.now())
+        for status, count in sorted(updates['outcomes'].items()):
+            print("# %d workers %s" % (count, status))
 
-    custom_id_primary = factory.Custom_IDType(
-        Custom_ID_Data=custom_id_data_primary, Delete=False)
+    def __call__(self, updates, context, row, workday_soap):
+        updates['pending'].append((row, updates['pool'].submit(
+            self.update, workday_soap, updates, row)))
 
-    custom_id_type_secondary = factory.Custom_ID_TypeObjectIDType(
-        "CUSTOM_ID_TYPE-3-25",
-        factory.Custom_ID_TypeReferenceEnumeration("Custom_ID_Type_ID"))
-    type_ref_secondary = factory.Custom_ID_TypeObjectType(
-        ID=[custom_id_type_secondary])
+        yield from self.collect(
+            context, updates, wait=len(updates['pending']) - 2 * self.workers)
 
-    custom_id_data_secondary = factory.Custom_ID_DataType(
-        ID="",
-        ID_Type_Reference=type_ref_secondary,
-        Issued_Date=datetime.datetime.now())
+    def collect(self, context, updates, wait=0):
+        pending = updates['pending']
+        while pending and (wait > 0 or pending[0][1].done()):
+            wait -= 1
+            row, future = pending.popleft()
 
-    custom_id_secondary = factory.Custom_IDType(
-        Custom_ID_Data=custom_id_data_secondary, Delete=False)
+            outcome = {
+                'EmployeeID': row['EmployeeID'],
+                'First_Name': row['wpr']['First_Name'],
+                'Last_Name': row['wpr']['Last_Name'],
+                'Old_Desk_Number': row['wpr']['WPR_Desk_Number'],
+                'New_Desk_Number': row['SeatID'],
+                'Error': None,
+            }
+            if DIGEST_FIELD in row:
+                outcome[DIGEST_FIELD] = row[DIGEST_FIELD]
 
-    custom = factory.Custom_Identification_DataType([custom_id_primary], True)
+            try:
+                outcome['Status'] = future.result()
+            except Exception as e:
+                outcome['Status'] = 'failed'
+                outcome['Error'] = str(e)
+                context.error(sys.exc_info())
 
-    emp_type = factory.WorkerObjectIDType(
-        row['EmployeeID'], factory.WorkerReferenceEnumeration(employee_type))
+            updates['outcomes'][outcome['Status']] += 1
+            yield outcome
 
-    worker = factory.WorkerObjectType(emp_type)
+    def update(self, workday_soap, updates, row):
+        factory = updates['factory']
+        static = updates['static']
 
-    change_id = factory.Change_Other_IDs_Business_Process_DataType(
-        Worker_Reference=worker, Custom_Identification_Data=custom)
+        if row['wpr']['Worker_Type'] == "Contingent Worker":
+            employee_type = "Contingent_Worker_ID"
+        else:
+            employee_type = "Employee_ID"
 
-    resp = None
+        custom_id_data_primary = factory.Custom_ID_DataType(
+            ID=row['SeatID'],
+            ID_Type_Reference=static['type_ref_primary'],
+            Issued_Date=datetime.datetime.now())
 
-    try:
-        resp = workday_soap.service.Change_Other_IDs(
-            version=WORKDAY_API_VERSION,
-            Business_Process_Parameters=bus_param,
-            Change_Other_IDs_Data=change_id,
-        )
+        custom_id_primary = factory.Custom_IDType(
+            Custom_ID_Data=custom_id_data_primary, Delete=False)
 
-    # Known bug with empty SOAP Body in responses
-    except IndexError as e:
-        resp = {
-            'Status': 'Nothing to do',
-        }
-    except zeep.exceptions.Fault as e:
-        raise e
+        custom = factory.Custom_Identification_DataType([custom_id_primary],
+                                                        True)
+
+        emp_type = factory.WorkerObjectIDType(
+            row['EmployeeID'],
+            factory.WorkerReferenceEnumeration(employee_type))
 
-    if resp:
-        yield resp
+        worker = factory.WorkerObjectType(emp_type)
+
+        change_id = factory.Change_Other_IDs_Business_Process_DataType(
+            Worker_Reference=worker, Custom_Identification_Data=custom)
+
+        updates['limiter'].wait()
+
+        print("XXX: [%s] Updating seat %s to %s for %s %s" %
+              (row['EmployeeID'], row['wpr']['WPR_Desk_Number'],
+               row['SeatID'], row['wpr']['First_Name'],
+               row['wpr']['Last_Name']))
+
+        try:
+            workday_soap.service.Change_Other_IDs(
+                version=WORKDAY_API_VERSION,
+                Business_Process_Parameters=static['bus_param'],
+                Change_Other_IDs_Data=change_id,
+            )
+        # Known bug with empty SOAP Body in responses
+        except IndexError:
+            return 'nothing to do'
+
+        return 'updated'
+
+
+def update_succeeded(outcome):
+    return outcome['Status'] != 'failed'
+
+
+def report_row(outcome):
+    """Outcome as a row of the update report, without the snapshot digest"""
+    yield {field: outcome.get(field) for field in REPORT_FIELDS}
 
 
 def get_cs_graph(**options):
@@ -243,6 +281,21 @@ def get_cs_graph(**options):
 
     split_employees = bonobo.noop
 
+    # Workday desk IDs, by employee, for the HrExport rows to look up
+    join_wpr = HashJoin(
+        ('EmployeeID', ),
+        build_key=('Employee_ID', ),
+        into='wpr',
+        unique=True)
+
+    graph.add_chain(get_wd_desk_ids, join_wpr.build, _name="wpr")
+
+    # Only look at the employees whose HrExport or WPR records changed
+    if options['full']:
+        changed = ()
+    else:
+        changed = (SkipUnchanged('EmployeeID', readonly=options['dry_run']), )
+
     graph.add_chain(
         bonobo.FileReader(
             path='HrExport.txt',
@@ -250,8 +303,9 @@ def get_cs_graph(**options):
             encoding='latin-1',
             eol="\r\n"),
         split_tabs,
+        join_wpr.probe,
+        *changed,
         prefix_desk_ids,
-        join_wpr,
         mismatch,
         split_employees,
         _name="main")
@@ -260,7 +314,11 @@ def get_cs_graph(**options):
     if options['dry_run']:
         update = ()
     else:
-        update = (update_employee_record, )
+        update = (UpdateEmployeeRecords(
+            workers=options['wd_workers'], rate_limit=options['wd_rate_limit']),
+                  report_row,
+                  bonobo.UnpackItems(0),
+                  bonobo.CsvWriter('centerstone_updates.csv'))
 
     graph.add_chain(
         bonobo.PrettyPrinter(),
@@ -268,6 +326,15 @@ def get_cs_graph(**options):
         bonobo.PrettyPrinter(),
         _input=split_employees)
 
+    # Employees are only snapshotted once in sync with Workday, the ones
+    # whose update failed or never ran get another go on the next run
+    if changed and not options['dry_run']:
+        graph.add_chain(
+            in_sync, CommitSnapshots('EmployeeID'), _input=prefix_desk_ids)
+        graph.add_chain(
+            CommitSnapshots('EmployeeID', predicate=update_succeeded),
+            _input=update[0])
+
     # Dump out outlier employees
     #graph.add_chain(
     #    bonobo.Filter(filter=odd_employee),
@@ -278,6 +345,16 @@ def get_cs_graph(**options):
     return graph
 
 
+def open_snapshots(services, dsn):
+    # Either one of the default engines, or its own DSN (sqlite for local runs)
+    if dsn in services:
+        engine = resolve(services, dsn)
+    else:
+        engine = create_engine(dsn, echo=False)
+
+    return SnapshotStore(engine, 'centerstone')
+
+
 def get_services(**options):
     """
     This function builds the services dictionary, which is a simple dict of names-to-implementation used by bonobo
@@ -289,16 +366,35 @@ def get_services(**options):
     :return: dict
     """
 
+    # Keep-alive connections for all the concurrent updates
+    session = requests.Session()
+    session.mount(
+        'https://',
+        requests.adapters.HTTPAdapter(pool_maxsize=options['wd_workers']))
+
+    wsdl = options['wd_wsdl'] or (
+        options['wd_base_url'] + 'ccx/service/{tenant}/Human_Resources/'.format(
+            tenant=options['wd_tenant']) + WORKDAY_API_VERSION + '?wsdl')
+
+    wsdl_cache = WsdlCache(
+        options['wd_wsdl_cache'],
+        options['wd_tenant'],
+        WORKDAY_API_VERSION,
+        ttl=options['wd_wsdl_ttl'],
+        offline=options['wd_offline'])
+
     wsdl_client = Client(
-        options['wd_base_url'] +
-        'ccx/service/{tenant}/Human_Resources/'.format(
-            tenant=options['wd_tenant']) + WORKDAY_API_VERSION + '?wsdl',
+        wsdl,
         wsse=UsernameToken(
             "%s@%s" % (options['wd_username'], options['wd_tenant']),
             options['wd_password'],
             use_digest=False),
+        transport=CachingTransport(wsdl_cache, session=session),
     )
 
+    print("# WSDL cache: %d documents cached, %d fetched" %
+          (wsdl_cache.hits, wsdl_cache.misses))
+
     wsdl_client.set_ns_prefix('bsvc', 'urn:com.workday/bsvc')
 
     return {
@@ -329,7 +425,13 @@ if __name__ == '__main__':
 
         __package__ = '.'.join(me)
 
-    from .. import add_default_arguments, add_default_services
+    from .. import (add_default_arguments, add_default_services,
+                    default_plugins, CachingTransport, CommitSnapshots,
+                    HashJoin, lazy, resolve, SkipUnchanged, SnapshotStore,
+                    WsdlCache)
+    from ..snapshots import DIGEST_FIELD
+    from ..workday import read_report
+    from ..wsdl import WSDL_TTL
 
     parser = bonobo.get_argument_parser()
 
@@ -340,12 +442,62 @@ if __name__ == '__main__':
         type=str,
         default=os.getenv('WD_BASE_URL', WORKDAY_BASE_URL))
 
+    parser.add_argument(
+        '--wd-workers',
+        type=int,
+        default=4,
+        help='Workday updates in flight')
+
+    parser.add_argument(
+        '--wd-rate-limit',
+        type=float,
+        default=5.0,
+        help='Maximum Workday updates per second')
+
+    parser.add_argument(
+        '--wd-wsdl',
+        type=str,
+        default=os.getenv('WD_WSDL'),
+        help='Load the Human_Resources WSDL from here instead')
+
+    parser.add_argument(
+        '--wd-wsdl-cache',
+        type=str,
+        default=os.getenv('WD_WSDL_CACHE', '.wsdl_cache'),
+        help='Where to keep the downloaded WSDL documents')
+
+    parser.add_argument(
+        '--wd-wsdl-ttl',
+        type=int,
+        default=int(os.getenv('WD_WSDL_TTL', WSDL_TTL)),
+        help='Seconds before the cached WSDL documents are revalidated')
+
+    parser.add_argument(
+        '--wd-offline',
+        action='store_true',
+        default=False,
+        help='Only use the cached WSDL documents')
+
+    parser.add_argument(
+        '--snapshot-dsn',
+        type=str,
+        default=os.getenv('BOOMI_STATE_DSN', 'sqlite:///etl_state.sqlite'),
+        help='Where to keep the employees seen last run, a DSN or an engine name')
+
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        default=False,
+        help='Look at all employees, not only the ones that changed')
+
     with bonobo.parse_args(parser) as options:
         services = get_services(**options)
         add_default_services(services, options)
 
-        print("# Running Workday deskid cache")
-        bonobo.run(get_wd_graph(**options), services=services)
+        services['snapshots'] = lazy(open_snapshots, services,
+                                     options['snapshot_dsn'])
 
-        print("# Running consolidation")
-        bonobo.run(get_cs_graph(**options), services=services)
+        bonobo.run(
+            get_cs_graph(**options),
+            services=services,
+            plugins=default_plugins(services))
@@ -0,0 +1,159 @@
+import collections
+import datetime
+import re
+
+from dateutil import parser as dateparser
+
+# Formats tried on the first values of a column, in order of preference
+DATE_FORMATS = (
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y/%m/%d %H:%M:%S',
+    '%Y-%m-%d',
+    '%Y/%m/%d',
+    '%m/%d/%Y %I:%M:%S %p',
+    '%m/%d/%Y %I:%M %p',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y',
+)
+
+SAMPLE_SIZE = 20
+CACHE_SIZE = 4096
+
+# strptime directives simple enough to be matched with a regex instead
+_DIRECTIVES = {
+    'Y': ('year', r'\d{4}'),
+    'm': ('month', r'\d{1,2}'),
+    'd': ('day', r'\d{1,2}'),
+    'H': ('hour', r'\d{1,2}'),
+    'M': ('minute', r'\d{1,2}'),
+    'S': ('second', r'\d{1,2}'),
+    'f': ('microsecond', r'\d{1,6}'),
+}
+
+
+def _compile(fmt):
+    """Regex with a named group per field for fmt, None if it can't have one"""
+    pattern = ''
+    for literal, directive in re.findall(r'([^%]*)(?:%(.))?', fmt):
+        pattern += re.escape(literal)
+        if directive:
+            if directive not in _DIRECTIVES:
+                return None
+            name, digits = _DIRECTIVES[directive]
+            pattern += '(?P<%s>%s)' % (name, digits)
+    return re.compile(pattern + r'\Z')
+
+
+class DateParser:
+    """
+    Drop-in for dateutil.parser.parse() on the values of a single column.
+
+    The first samples values are parsed by dateutil, and used to find a
+    format that gives the same results for all of them. The following
+    values are then parsed with that format (with a regex when its fields
+    are all numeric, with strptime otherwise), and with dateutil only if it
+    doesn't match. The last cache_size distinct values are memoized.
+
+    stats counts the values parsed by each path.
+    """
+
+    def __init__(self, formats=DATE_FORMATS, samples=SAMPLE_SIZE,
+                 cache_size=CACHE_SIZE):
+        self.candidates = list(formats)
+        self.samples = samples
+        self.cache_size = cache_size
+        self.format = None
+        self.stats = collections.Counter()
+
+        self._regex = None
+        self._cache = collections.OrderedDict()
+
+    def __call__(self, value):
+        try:
+            parsed = self._cache[value]
+        except KeyError:
+            pass
+        else:
+            self._cache.move_to_end(value)
+            self.stats['cached'] += 1
+            return parsed
+
+        parsed = self.parse(value)
+
+        self._cache[value] = parsed
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return parsed
+
+    def parse(self, value):
+        if self.format is not None:
+            try:
+                parsed = self._fast(value)
+            except ValueError:
+                pass
+            else:
+                self.stats['fast'] += 1
+                return parsed
+
+        self.stats['fallback'] += 1
+        parsed = dateparser.parse(value)
+
+        if self.format is None and self.candidates:
+            self._sample(value, parsed)
+
+        return parsed
+
+    def _fast(self, value):
+        if self._regex is None:
+            return datetime.datetime.strptime(value, self.format)
+
+        match = self._regex.match(value)
+        if match is None:
+            raise ValueError(value)
+
+        fields = match.groupdict()
+        if 'microsecond' in fields:
+            fields['microsecond'] = fields['microsecond'].ljust(6, '0')
+        return datetime.datetime(**{
+            name: int(field)
+            for name, field in fields.items()
+        })
+
+    def _sample(self, value, parsed):
+        # Only keep the formats agreeing with dateutil on every sample
+        self.candidates = [
+            fmt for fmt in self.candidates
+            if parsed.tzinfo is None and _strptime(value, fmt) == parsed
+        ]
+
+        self.samples -= 1
+        if self.samples <= 0 and self.candidates:
+            self.format = self.candidates[0]
+            self._regex = _compile(self.format)
+
+    def summary(self):
+        return "%d dates parsed: %d fast, %d cached, %d by dateutil%s" % (
+            sum(self.stats.values()), self.stats['fast'],
+            self.stats['cached'], self.stats['fallback'],
+            ' (format %s)' % self.format if self.format else '')
+
+
+def _strptime(value, fmt):
+    try:
+        return datetime.datetime.strptime(value, fmt)
+    except ValueError:
+        return None
+
+
+def date_parsers(self, context):
+    """Context processor giving a node one DateParser per field"""
+    parsers = collections.defaultdict(DateParser)
+
+    yield parsers
+
+    for field, parser in sorted(parsers.items()):
+        print("# %s: %s" % (field, parser.summary()))
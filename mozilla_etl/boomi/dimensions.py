@@ -0,0 +1,156 @@
+import collections
+
+from sqlalchemy import MetaData, Table, select
+
+
+class DimensionCache:
+    """
+    In-memory lookup of a dimension table keyed by one of its columns.
+
+    By default the whole dimension is loaded with a single query on first
+    access, after which every lookup is a dict access. With max_size set, rows
+    are fetched on demand instead and kept in an LRU of that size, prefetch()
+    fills misses for many keys at once with batched IN (...) queries.
+
+    In LRU mode, keys that are not found are cached too, so a missing key is
+    only ever queried once.
+    """
+
+    def __init__(self, engine, table_name, key, max_size=None,
+                 batch_size=1000):
+        self.engine = engine
+        self.table_name = table_name
+        self.key = key
+        self.max_size = max_size
+        self.batch_size = batch_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._table = None
+        self._rows = None
+
+    def __str__(self):
+        return "Dimension %s by %s: %d hits, %d misses, %d cached" % (
+            self.table_name, self.key, self.hits, self.misses,
+            len(self._rows or ()))
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = Table(
+                self.table_name,
+                MetaData(),
+                autoload=True,
+                autoload_with=self.engine)
+        return self._table
+
+    @property
+    def column(self):
+        return self.table.c[self.key]
+
+    @property
+    def used(self):
+        return self._rows is not None
+
+    def coerce(self, value):
+        """Cast a lookup value to the key column type, as the database would"""
+        try:
+            python_type = self.column.type.python_type
+        except NotImplementedError:
+            return value
+
+        if value is None or isinstance(value, python_type):
+            return value
+
+        try:
+            return python_type(value)
+        except (TypeError, ValueError):
+            return value
+
+    def load(self):
+        if self.max_size:
+            self._rows = collections.OrderedDict()
+            return
+
+        with self.engine.connect() as connection:
+            self._rows = {
+                row[self.key]: row
+                for row in connection.execute(select([self.table]))
+            }
+
+    def prefetch(self, values):
+        """Fetch all the given keys not already cached, in batches"""
+        if self._rows is None:
+            self.load()
+
+        if not self.max_size:
+            return
+
+        missing = []
+        for value in set(map(self.coerce, values)):
+            if value not in self._rows:
+                missing.append(value)
+
+        with self.engine.connect() as connection:
+            for i in range(0, len(missing), self.batch_size):
+                batch = missing[i:i + self.batch_size]
+                found = {
+                    row[self.key]: row
+                    for row in connection.execute(
+                        select([self.table]).where(self.column.in_(batch)))
+                }
+                for value in batch:
+                    self._store(value, found.get(value))
+
+    def get(self, value, default=None):
+        if self._rows is None:
+            self.load()
+
+        value = self.coerce(value)
+
+        if value in self._rows:
+            self.hits += 1
+            row = self._rows[value]
+            if self.max_size:
+                self._rows.move_to_end(value)
+        else:
+            self.misses += 1
+            row = None
+            if self.max_size:
+                self.prefetch((value, ))
+                row = self._rows.get(value)
+
+        if row is None:
+            return default
+
+        return row
+
+    def _store(self, value, row):
+        self._rows[value] = row
+        while len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+
+
+def lookup_dimensions(context, engine, **dimensions):
+    """
+    Context processor body providing named DimensionCache instances, declared
+    as name=(table_name, key_column) or name=(table_name, key_column, options).
+
+    Usage:
+
+        def _lookup_sk(self, context, database):
+            yield from lookup_dimensions(
+                context, database, date=('dim_date', 'date'))
+    """
+    caches = {}
+    for name, spec in dimensions.items():
+        table_name, key, *options = spec
+        caches[name] = DimensionCache(engine, table_name, key,
+                                      **(options[0] if options else {}))
+
+    yield {'ctx': context, **caches}
+
+    for cache in caches.values():
+        if cache.used:
+            print("# %s" % cache)
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+# Default freshness rules, first matching pattern wins: Workday RaaS reports
+# only change a few times a day, anything else is always revalidated.
+HTTP_CACHE_TTLS = (
+    (r'/ccx/service/customreport2/', 3600),
+)
+
+HTTP_CACHE_SIZE = 512 * 1024 * 1024
+
+# Not replayed from the cache, the body is stored decoded
+_HOP_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding',
+                'connection', 'keep-alive')
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    requests transport adapter caching the successful GET responses of a
+    session in a directory of its own.
+
+    A cached response is served as is while younger than the TTL of the
+    first pattern of ttls (pairs of a regex and seconds) its URL matches.
+    Once expired, it is revalidated with If-None-Match / If-Modified-Since
+    when it has an ETag or a Last-Modified, and downloaded again otherwise.
+
+    Bodies are kept on disk and served from there, so caching doesn't add
+    to memory use. A miss is streamed to the caller as it downloads, and
+    only stored once read to the end. The least recently used responses are
+    evicted past max_size bytes. Responses carry a cache_status (hit,
+    revalidated or miss), also counted in stats.
+    """
+
+    def __init__(self, path, ttls=HTTP_CACHE_TTLS, max_size=HTTP_CACHE_SIZE,
+                 **kwargs):
+        super().__init__(**kwargs)
+
+        self.path = path
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.stats = {'hit': 0, 'revalidated': 0, 'miss': 0, 'evicted': 0}
+
+        os.makedirs(path, exist_ok=True)
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return 0
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, **kwargs)
+
+        entry = os.path.join(self.path,
+                             hashlib.sha1(request.url.encode('utf-8')).hexdigest())
+        meta = self.load(entry)
+
+        if meta and time.time() - meta['stored_at'] < self.ttl(request.url):
+            return self.replay(request, entry, meta, 'hit')
+
+        if meta:
+            if meta['headers'].get('etag'):
+                request.headers['If-None-Match'] = meta['headers']['etag']
+            if meta['headers'].get('last-modified'):
+                request.headers['If-Modified-Since'] = meta['headers'][
+                    'last-modified']
+
+        resp = super().send(request, **kwargs)
+
+        if meta and resp.status_code == 304:
+            resp.close()
+            # The validators may have moved on, even with the same content
+            for name in ('etag', 'last-modified'):
+                if resp.headers.get(name):
+                    meta['headers'][name] = resp.headers[name]
+            meta['stored_at'] = time.time()
+            self.save_meta(entry, meta)
+            return self.replay(request, entry, meta, 'revalidated')
+
+        resp.cache_status = 'miss'
+        with self.lock:
+            self.stats['miss'] += 1
+
+        if resp.status_code == 200:
+            resp.raw = _TeeRaw(self, entry, resp)
+        return resp
+
+    def load(self, entry):
+        try:
+            with open(entry + '.json') as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if not os.path.exists(entry + '.body'):
+            return None
+        return meta
+
+    def save_meta(self, entry, meta):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(meta, file)
+        os.replace(tmp, entry + '.json')
+
+    def replay(self, request, entry, meta, status):
+        # Touched to keep track of the least recently used
+        os.utime(entry + '.json')
+
+        body = open(entry + '.body', 'rb')
+        headers = dict(meta['headers'])
+        headers['content-length'] = str(os.fstat(body.fileno()).st_size)
+
+        resp = self.build_response(
+            request,
+            HTTPResponse(
+                body=body,
+                headers=headers,
+                status=meta['status'],
+                reason=meta['reason'],
+                preload_content=False,
+                decode_content=False))
+        resp.cache_status = status
+
+        with self.lock:
+            self.stats[status] += 1
+        return resp
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            entry = os.path.join(self.path, name[:-len('.json')])
+            try:
+                size = os.path.getsize(entry + '.body')
+                used = os.path.getmtime(entry + '.json')
+            except OSError:
+                continue
+            entries.append((used, size, entry))
+            total += size
+
+        for used, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            for suffix in ('.json', '.body'):
+                try:
+                    os.unlink(entry + suffix)
+                except OSError:
+                    pass
+            total -= size
+            with self.lock:
+                self.stats['evicted'] += 1
+
+
+class _TeeRaw:
+    """
+    Stands in for the urllib3 response of a miss, writing the decoded body
+    to the cache as the caller streams it. The entry is only stored once the
+    body was read to the end, reading it any other way (raw.read(), ...)
+    leaves it out of the cache.
+    """
+
+    def __init__(self, adapter, entry, resp):
+        self._raw = resp.raw
+        self._adapter = adapter
+        self._entry = entry
+        self._meta = {
+            'url': resp.url,
+            'status': resp.status_code,
+            'reason': resp.reason,
+            'headers': {
+                name.lower(): value
+                for name, value in resp.headers.items()
+                if name.lower() not in _HOP_HEADERS
+            },
+        }
+
+        fd, self._tmp = tempfile.mkstemp(dir=adapter.path, suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def stream(self, amt=2**16, decode_content=None):
+        if not decode_content:
+            # Only decoded bodies are stored
+            self._discard()
+            yield from self._raw.stream(amt, decode_content=decode_content)
+            return
+
+        for chunk in self._raw.stream(amt, decode_content=True):
+            if self._file is not None:
+                self._file.write(chunk)
+            yield chunk
+
+        self._commit()
+
+    def close(self):
+        self._discard()
+        self._raw.close()
+
+    def __del__(self):
+        self._discard()
+
+    def _commit(self):
+        if self._file is None:
+            return
+
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp, self._entry + '.body')
+
+        self._meta['stored_at'] = time.time()
+        self._adapter.save_meta(self._entry, self._meta)
+        self._adapter.evict()
+
+    def _discard(self):
+        if self._file is None:
+            return
+
+        self._file.close()
+        self._file = None
+        os.unlink(self._tmp)
+
+
+def parse_ttl(value):
+    """A PATTERN=SECONDS command line argument"""
+    pattern, _, seconds = value.rpartition('=')
+    return pattern, int(seconds)
@@ -0,0 +1,391 @@
+import datetime
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+from bonobo.execution import events
+from bonobo.plugins import Plugin
+from fs.base import FS
+from fs.wrapfs import WrapFS
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .services import lazy
+
+# Latency histogram upper bounds, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, float('inf'))
+
+
+class Histogram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    self.buckets[i] += 1
+                    break
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else 0,
+            'buckets': {
+                _bound(bound): count
+                for bound, count in zip(BUCKETS, self.buckets)
+            },
+        }
+
+
+class ServiceMetrics:
+    def __init__(self, kind):
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.latency = Histogram()
+        self.counters = {}
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def as_dict(self):
+        return dict(
+            kind=self.kind, latency=self.latency.as_dict(), **self.counters)
+
+
+class Instrumentation(Plugin):
+    """
+    Timing and throughput metrics for a job, reported after each bonobo.run().
+
+    As a bonobo plugin, it times every call of every node and samples the
+    depth of their input queues. wrap() makes services report to it too:
+    SQLAlchemy engines time their statements, requests sessions their
+    requests and the bytes sent and received, filesystems count the bytes
+    read and written through them.
+
+    After each run, all the runs so far are written to report_path as JSON,
+    and the last one to textfile_path in the Prometheus textfile format.
+    """
+
+    def __init__(self, report_path=None, textfile_path=None, job=None):
+        self.report_path = report_path
+        self.textfile_path = textfile_path
+        self.job = job or _job_name()
+        self.runs = []
+        self.services = {}
+
+        self._started = None
+        self._nodes = None
+
+    def register(self, dispatcher):
+        dispatcher.add_listener(events.START, self.on_start)
+        dispatcher.add_listener(events.TICK, self.on_tick)
+        dispatcher.add_listener(events.STOPPED, self.on_stopped)
+
+    def unregister(self, dispatcher):
+        dispatcher.remove_listener(events.STOPPED, self.on_stopped)
+        dispatcher.remove_listener(events.TICK, self.on_tick)
+        dispatcher.remove_listener(events.START, self.on_start)
+
+    def on_start(self, event):
+        self._started = time.time()
+        self._nodes = []
+        for node in event.context.nodes:
+            metrics = {
+                'node': node,
+                'latency': Histogram(),
+                'queue_max': 0,
+                'queue_sum': 0,
+                'queue_samples': 0,
+            }
+            node.step = self._timed(node.step, metrics['latency'])
+            self._nodes.append(metrics)
+
+        for metrics in self.services.values():
+            metrics.reset()
+
+    def on_tick(self, event):
+        for metrics in self._nodes or ():
+            depth = metrics['node'].input.qsize()
+            metrics['queue_max'] = max(metrics['queue_max'], depth)
+            metrics['queue_sum'] += depth
+            metrics['queue_samples'] += 1
+
+    def on_stopped(self, event):
+        elapsed = time.time() - self._started
+
+        nodes = []
+        for metrics in self._nodes:
+            node = metrics['node']
+            stats = dict(node.get_statistics())
+            nodes.append({
+                'name': node.__name__,
+                'in': stats.get('in', 0),
+                'out': stats.get('out', 0),
+                'err': stats.get('err', 0),
+                'rows_per_second': stats.get('in', 0) / elapsed
+                if elapsed else 0,
+                'latency': metrics['latency'].as_dict(),
+                'queue': {
+                    'max': metrics['queue_max'],
+                    'mean': metrics['queue_sum'] / metrics['queue_samples']
+                    if metrics['queue_samples'] else 0,
+                },
+            })
+
+        self.runs.append({
+            'job': self.job,
+            'run': len(self.runs) + 1,
+            'started': datetime.datetime.fromtimestamp(
+                self._started).isoformat(),
+            'elapsed': elapsed,
+            'nodes': nodes,
+            'services': {
+                name: metrics.as_dict()
+                for name, metrics in sorted(self.services.items())
+            },
+        })
+        self._nodes = None
+
+        if self.report_path:
+            _atomic_write(self.report_path,
+                          json.dumps({'runs': self.runs}, indent=2))
+
+        if self.textfile_path:
+            _atomic_write(self.textfile_path, self.prometheus(self.runs[-1]))
+
+    @staticmethod
+    def _timed(step, histogram):
+        def timed_step():
+            started = time.perf_counter()
+            step()
+            # Steps raising Empty only waited for input, they are not counted
+            histogram.observe(time.perf_counter() - started)
+
+        return timed_step
+
+    def wrap(self, name, service):
+        """Instrument a service if it is of a known kind, return what to use"""
+        if isinstance(service, Engine):
+            self._wrap_engine(self._metrics(name, 'sql'), service)
+        elif isinstance(service, requests.Session):
+            self._wrap_session(self._metrics(name, 'http'), service)
+        elif isinstance(service, FS):
+            service = InstrumentedFS(service, self._metrics(name, 'fs'))
+        return service
+
+    def _metrics(self, name, kind):
+        return self.services.setdefault(name, ServiceMetrics(kind))
+
+    @staticmethod
+    def _wrap_engine(metrics, engine):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before(conn, cursor, statement, parameters, context, many):
+            conn.info.setdefault('query_started', []).append(
+                time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after(conn, cursor, statement, parameters, context, many):
+            started = conn.info['query_started'].pop()
+            metrics.latency.observe(time.perf_counter() - started)
+            metrics.increment('statements')
+            if cursor.rowcount and cursor.rowcount > 0:
+                metrics.increment('rows', cursor.rowcount)
+
+        @event.listens_for(engine, 'handle_error')
+        def error(context):
+            metrics.increment('errors')
+            if context.connection is not None:
+                started = context.connection.info.get('query_started')
+                if started:
+                    started.pop()
+
+    @staticmethod
+    def _wrap_session(metrics, session):
+        def response(resp, *args, **kwargs):
+            metrics.latency.observe(resp.elapsed.total_seconds())
+            metrics.increment('requests')
+            if resp.status_code >= 400:
+                metrics.increment('errors')
+            # Reading the body here would defeat streamed downloads. Cache
+            # hits and revalidations come from the disk, not the network.
+            if getattr(resp, 'cache_status', 'miss') == 'miss':
+                metrics.increment('bytes_received',
+                                  int(resp.headers.get('Content-Length', 0)))
+            body = resp.request.body
+            if body:
+                metrics.increment('bytes_sent', len(body))
+            # Set by CachingAdapter
+            if hasattr(resp, 'cache_status'):
+                metrics.increment('cache_' + resp.cache_status)
+
+        session.hooks['response'].append(response)
+
+    def prometheus(self, run):
+        labels = 'job="%s"' % self.job
+        lines = [
+            '# TYPE boomi_run_seconds gauge',
+            'boomi_run_seconds{%s} %f' % (labels, run['elapsed']),
+        ]
+
+        lines.append('# TYPE boomi_node_rows_total counter')
+        for node in run['nodes']:
+            for direction in ('in', 'out', 'err'):
+                lines.append(
+                    'boomi_node_rows_total{%s,node="%s",direction="%s"} %d' %
+                    (labels, node['name'], direction, node[direction]))
+
+        lines.append('# TYPE boomi_node_queue_max gauge')
+        for node in run['nodes']:
+            lines.append('boomi_node_queue_max{%s,node="%s"} %d' %
+                         (labels, node['name'], node['queue']['max']))
+
+        lines.append('# TYPE boomi_node_seconds histogram')
+        for node in run['nodes']:
+            lines.extend(
+                _histogram_lines('boomi_node_seconds', '%s,node="%s"' %
+                                 (labels, node['name']), node['latency']))
+
+        lines.append('# TYPE boomi_service_seconds histogram')
+        for name, service in run['services'].items():
+            lines.extend(
+                _histogram_lines('boomi_service_seconds',
+                                 '%s,service="%s",kind="%s"' %
+                                 (labels, name, service['kind']),
+                                 service['latency']))
+
+        lines.append('# TYPE boomi_service_total counter')
+        for name, service in run['services'].items():
+            for counter, value in sorted(service.items()):
+                if counter in ('kind', 'latency'):
+                    continue
+                lines.append(
+                    'boomi_service_total{%s,service="%s",counter="%s"} %d' %
+                    (labels, name, counter, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedFS(WrapFS):
+    """Filesystem wrapper counting files opened and bytes moved"""
+
+    def __init__(self, wrap_fs, metrics):
+        super().__init__(wrap_fs)
+        self._metrics = metrics
+
+    def openbin(self, path, mode='r', buffering=-1, **options):
+        self._metrics.increment('opens')
+        started = time.perf_counter()
+        try:
+            file = super().openbin(path, mode, buffering, **options)
+        finally:
+            self._metrics.latency.observe(time.perf_counter() - started)
+        return CountingFile(file, self._metrics)
+
+    def open(self, path, mode='r', buffering=-1, encoding=None, errors=None,
+             newline='', **options):
+        # FS.open goes through self.openbin, WrapFS.open would bypass it
+        return FS.open(self, path, mode, buffering, encoding, errors, newline,
+                       **options)
+
+
+class CountingFile(io.RawIOBase):
+    def __init__(self, file, metrics):
+        self._file = file
+        self._metrics = metrics
+
+    def readable(self):
+        return self._file.readable()
+
+    def writable(self):
+        return self._file.writable()
+
+    def seekable(self):
+        return self._file.seekable()
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def readinto(self, buffer):
+        count = self._file.readinto(buffer)
+        if count:
+            self._metrics.increment('bytes_read', count)
+        return count
+
+    def write(self, data):
+        count = self._file.write(data)
+        self._metrics.increment('bytes_written',
+                                len(data) if count is None else count)
+        return count
+
+    def flush(self):
+        if not self.closed:
+            self._file.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._file.close()
+            finally:
+                super().close()
+
+
+def _bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def _histogram_lines(name, labels, histogram):
+    cumulative = 0
+    for bound, count in histogram['buckets'].items():
+        cumulative += count
+        yield '%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative)
+    yield '%s_sum{%s} %f' % (name, labels, histogram['sum'])
+    yield '%s_count{%s} %d' % (name, labels, histogram['count'])
+
+
+def _atomic_write(path, content):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as file:
+        file.write(content)
+    os.replace(tmp, path)
+
+
+def _job_name():
+    # Jobs run as mozilla_etl/boomi/<area>/<job>/__main__.py
+    parts = os.path.abspath(sys.argv[0]).split(os.sep)
+    if 'boomi' in parts:
+        return '.'.join(parts[parts.index('boomi') + 1:-1])
+    return os.path.basename(sys.argv[0])
+
+
+def instrument_services(instrumentation, services):
+    """Wrap all the services of a services dict, lazy ones when first built"""
+    for name, service in list(services.items()):
+        if callable(getattr(service, 'built', None)):
+            services[name] = lazy(_wrap_lazy, instrumentation, name, service)
+        else:
+            services[name] = instrumentation.wrap(name, service)
+
+
+def _wrap_lazy(instrumentation, name, service):
+    return instrumentation.wrap(name, service())
@@ -1,12 +1,11 @@
 import bonobo
-import bonobo_sqlalchemy
 import os
 
-from bonobo.config import Service, use, use_no_input, use_context
+from bonobo.config import Service, use, use_no_input, use_context, use_context_processor
 from bonobo.config.functools import transformation_factory
 from bonobo.constants import NOT_MODIFIED
 
-from dateutil import parser as dateparser
+from mozilla_etl.boomi.dates import date_parsers
 
 import re
 
@@ -46,11 +45,12 @@ def GetOrderXML(glob=[], prefix="/etl/ivm"):
 def ParseDates(fields):
     fields = list(fields)
 
-    def _ParseDates(row):
+    @use_context_processor(date_parsers)
+    def _ParseDates(parsers, row):
         modified = False
         for key in fields:
             if key in row:
-                date = dateparser.parse(row[key])
+                date = parsers[key](row[key])
                 if date:
                     row[key] = date.date()
                     modified = True
@@ -109,13 +109,12 @@ def get_graph(**options):
 
     #insert into ivm (description, transaction_id, item_number, item_description, user_id, quantity, transaction_date, transaction_code) values
 
-    for engine in list(set(options['engine'])):
-        graph.add_chain(
-            bonobo_sqlalchemy.InsertOrUpdate(
-                table_name=options['table_name'] + options['table_suffix'],
-                discriminant=('transaction_id', ),
-                engine=engine),
-            _input=split_dbs)
+    graph.add_chain(
+        FanOutInsertOrUpdate(
+            table_name=options['table_name'] + options['table_suffix'],
+            discriminant=('transaction_id', ),
+            engines=options['engine']),
+        _input=split_dbs)
 
     return graph
 
@@ -155,7 +154,7 @@ if __name__ == '__main__':
 
         __package__ = '.'.join(me)
 
-    from ... import add_default_arguments, add_default_services
+    from ... import add_default_arguments, add_default_services, default_plugins, FanOutInsertOrUpdate
 
     parser = bonobo.get_argument_parser()
 
@@ -167,4 +166,7 @@ if __name__ == '__main__':
     with bonobo.parse_args(parser) as options:
         services = get_services(**options)
         add_default_services(services, options)
-        bonobo.run(get_graph(**options), services=services)
+        bonobo.run(
+            get_graph(**options),
+            services=services,
+            plugins=default_plugins(services))
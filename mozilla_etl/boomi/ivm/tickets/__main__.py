@@ -1,12 +1,12 @@
 import bonobo
-import bonobo_sqlalchemy
+import collections
+import datetime
 import os
 
-from bonobo.config import use, use_context, use_raw_input
-
-from bonobo.constants import NOT_MODIFIED
+from bonobo.config import use, use_context, use_raw_input, use_context_processor
 
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import create_engine
 
 SN_TEST_URL = 'https://mozilla.service-now.com/u_mozilla_vending_webservice.do?JSONv2&sysparm_action=insertMultiple'
 
@@ -19,72 +19,92 @@ def get_graph(**options):
 
     """
 
-    now = options['now']
-
-    # Null out time portion, go back 2 days in the past
-    now += relativedelta(days=-2, hour=0, minute=0, second=0, microsecond=0)
+    start, end = get_date_range(**options)
 
-    print("# Processing for %s" % now.date())
+    if end - start > datetime.timedelta(days=1):
+        print("# Processing from %s to %s" %
+              (start, end - datetime.timedelta(days=1)))
+    else:
+        print("# Processing for %s" % start)
 
     graph = bonobo.Graph()
 
-    STMT = """
-select a.badgeid AS badgeid, b.user_id AS user_id, a.employee_id AS employee_id, a.email AS email, 
-b.item_description AS item_description, b.item_number AS item_number , b.transaction_date AS transaction_date,
-b.transaction_id AS transaction_id, b.description AS description, '' AS drawer_id, b.quantity AS quantity
-from  ivm b , (select badgeid,email, employee_id from f_employee group by badgeid,email ,employee_id) a
-where  b.user_id = a.badgeid
-and b.transaction_date = '{now}';
-"""
+    # Leave out what an earlier run already sent, unless asked not to
+    skip = () if options['resubmit'] else (SkipSubmitted('u_transactionid'), )
 
     graph.add_chain(
-        bonobo_sqlalchemy.Select(STMT.format(now=now), engine='redshift'),
-        trim_employee_id,
-        invalid_badge_id,
-        invalid_email,
+        StreamingSelect(
+            STMT,
+            parameters={
+                'start': start,
+                'end': end
+            },
+            chunk_size=options['chunk_size'],
+            engine='redshift'),
         format_payload,
-        create_ticket,
+        *skip,
+        InsertMultiple(
+            SN_TEST_URL,
+            batch_size=options['batch_size'],
+            workers=options['workers']),
+        RecordSubmitted('u_transactionid'),
         bonobo.UnpackItems(0),
     )
 
     return graph
 
 
-import json
+STMT = """
+select a.badgeid AS badgeid, b.user_id AS user_id, a.employee_id AS employee_id, a.email AS email,
+b.item_description AS item_description, b.item_number AS item_number , b.transaction_date AS transaction_date,
+b.transaction_id AS transaction_id, b.description AS description, '' AS drawer_id, b.quantity AS quantity
+from  ivm b , (select badgeid,email, employee_id from f_employee group by badgeid,email ,employee_id) a
+where  b.user_id = a.badgeid
+and b.transaction_date >= :start and b.transaction_date < :end
+"""
 
 
-@use('servicenow')
-def create_ticket(row, servicenow):
-    resp = servicenow.post(SN_TEST_URL, data=json.dumps(row))
+def get_date_range(**options):
+    """
+    Transaction dates to process, as a half-open [start, end) range: from
+    --from to --to included when given, otherwise the day 2 days before
+    --now.
+    """
+    if options['date_from']:
+        start = options['date_from'].date()
+        end = (options['date_to'] or options['date_from']).date()
+    else:
+        # Null out time portion, go back 2 days in the past
+        start = end = (options['now'] + relativedelta(days=-2)).date()
 
-    yield from resp.json().get('records')
+    return start, end + datetime.timedelta(days=1)
 
 
-def trim_employee_id(badgeid, user_id, employee_id, email, item_description,
-                     item_number, transaction_date, transaction_id,
-                     description, drawer_id, quantity):
-    yield (badgeid, user_id, employee_id.strip(), email, item_description,
-           item_number, transaction_date, transaction_id, description,
-           drawer_id, quantity)
+def _rejections(self, context):
+    rejected = yield collections.Counter()
 
+    for rule, count in sorted(rejected.items()):
+        print("# Rejected %d rows: %s" % (count, rule))
 
-def invalid_badge_id(badgeid, user_id, employee_id, email, item_description,
-                     item_number, transaction_date, transaction_id,
-                     description, drawer_id, quantity):
-    if badgeid != 0:
-        return NOT_MODIFIED
 
+@use_context_processor(_rejections)
+def format_payload(rejected, badgeid, user_id, employee_id, email,
+                   item_description, item_number, transaction_date,
+                   transaction_id, description, drawer_id, quantity):
+    """
+    Trim, validate and format transactions in a single node, rows failing
+    a rule are counted under its name.
+    """
+    employee_id = employee_id.strip()
 
-def invalid_email(badgeid, user_id, employee_id, email, item_description,
-                  item_number, transaction_date, transaction_id, description,
-                  drawer_id, quantity):
-    if email != '':
-        return NOT_MODIFIED
+    if badgeid == 0:
+        rejected['invalid_badge_id'] += 1
+        return
 
+    if email == '':
+        rejected['invalid_email'] += 1
+        return
 
-def format_payload(badgeid, user_id, employee_id, email, item_description,
-                   item_number, transaction_date, transaction_id, description,
-                   drawer_id, quantity):
     yield {
         "u_badgenumber": badgeid,
         "u_employeeid": employee_id,
@@ -97,6 +117,16 @@ def format_payload(badgeid, user_id, employee_id, email, item_description,
     }
 
 
+def open_ledger(services, dsn):
+    # Either one of the default engines, or its own DSN (sqlite for local runs)
+    if dsn in services:
+        engine = resolve(services, dsn)
+    else:
+        engine = create_engine(dsn, echo=False)
+
+    return SubmissionLedger(engine, 'ivm_tickets')
+
+
 def get_services(**options):
     """
     This function builds the services dictionary, which is a simple dict of names-to-implementation used by bonobo
@@ -131,13 +161,64 @@ if __name__ == '__main__':
 
         __package__ = '.'.join(me)
 
-    from ... import add_default_arguments, add_default_services
+    from ... import (add_default_arguments, add_default_services,
+                     default_plugins, InsertMultiple, lazy, RecordSubmitted,
+                     resolve, SkipSubmitted, StreamingSelect,
+                     SubmissionLedger, valid_date)
 
     parser = bonobo.get_argument_parser()
 
     add_default_arguments(parser)
 
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=100,
+        help='Records per insertMultiple request')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='insertMultiple requests in flight')
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=5000,
+        help='Rows fetched at once from the warehouse')
+    parser.add_argument(
+        '--ledger-dsn',
+        type=str,
+        default=os.getenv('BOOMI_STATE_DSN', 'sqlite:///etl_state.sqlite'),
+        help='Where to track submitted transactions, a DSN or an engine name')
+    parser.add_argument(
+        '--resubmit',
+        action='store_true',
+        default=False,
+        help='Send transactions even if they were submitted before')
+    parser.add_argument(
+        '--from',
+        dest='date_from',
+        type=valid_date,
+        default=None,
+        help='First transaction date of a range to process, instead of --now')
+    parser.add_argument(
+        '--to',
+        dest='date_to',
+        type=valid_date,
+        default=None,
+        help='Last transaction date of the range, --from if not given')
+
     with bonobo.parse_args(parser) as options:
+        if options['date_to'] and not options['date_from']:
+            parser.error('--to requires --from')
+        if options['date_to'] and options['date_to'] < options['date_from']:
+            parser.error('--to is before --from')
+
         services = get_services(**options)
         add_default_services(services, options)
-        bonobo.run(get_graph(**options), services=services)
+        services['ledger'] = lazy(open_ledger, services,
+                                  options['ledger_dsn'])
+        bonobo.run(
+            get_graph(**options),
+            services=services,
+            plugins=default_plugins(services))
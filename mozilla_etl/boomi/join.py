@@ -0,0 +1,223 @@
+import queue
+import shelve
+import threading
+
+from bonobo.config import Configurable, ContextProcessor, Option, use_context, use_no_input
+
+MODES = ('inner', 'left', 'anti')
+
+# Marks the end of an unmatched rows queue
+_DONE = object()
+
+
+class HashJoin:
+    """
+    Join two chains of the same graph yielding dicts, on key fields: rows
+    reaching the build node are hashed into a table, rows reaching the probe
+    node are joined against it once the build side is done, and streamed
+    downstream.
+
+        join = HashJoin(('EmployeeID', ), build_key=('Employee_ID', ))
+        graph.add_chain(read_workers, join.build)
+        graph.add_chain(read_seats, join.probe, ...)
+
+    Matched build rows are merged into the probe row, or set in its into
+    field. inner sends matched probe rows, left all of them (into set to None
+    when unmatched), anti only the unmatched ones. The probe rows that were
+    not sent and the build rows that never matched can be read from the
+    unmatched and unmatched_build source nodes.
+
+    The table is a dict, or a shelve file at path for build sides too large
+    for memory. With unique, only the first build row of a key is kept.
+
+    Probe rows are held until the build node is done. The naive strategy
+    runs the nodes one after the other in the order they were added, so add
+    the build chain first there.
+    """
+
+    def __init__(self,
+                 key,
+                 build_key=None,
+                 mode='inner',
+                 into=None,
+                 unique=False,
+                 path=None):
+        if mode not in MODES:
+            raise ValueError('Unknown join mode %r, use one of %s.' %
+                             (mode, ', '.join(MODES)))
+
+        self.key = tuple(key)
+        self.build_key = tuple(build_key or key)
+        self.mode = mode
+        self.into = into
+        self.unique = unique
+        self.path = path
+
+        self.table = None
+        self.built = threading.Event()
+        self.matched = set()
+        self.queues = {}
+
+        self.build = _JoinBuild(self)
+        self.probe = _JoinProbe(self)
+
+    @property
+    def unmatched(self):
+        return self._unmatched('probe')
+
+    @property
+    def unmatched_build(self):
+        return self._unmatched('build')
+
+    def _unmatched(self, side):
+        if side not in self.queues:
+            self.queues[side] = queue.Queue()
+        return _JoinUnmatched(self, side)
+
+    def open_table(self):
+        self.table = {} if self.path is None else shelve.open(self.path, 'n')
+        self.matched.clear()
+
+    def add(self, row):
+        """Hash a build row, False if it was dropped as a duplicate"""
+        key = _key(row, self.build_key)
+        if self.path is not None:
+            key = repr(key)
+
+        rows = self.table.get(key)
+        if rows and self.unique:
+            return False
+
+        # shelve only persists what is assigned back
+        self.table[key] = (rows or []) + [row]
+        return True
+
+    def lookup(self, row):
+        key = _key(row, self.key)
+        if self.path is not None:
+            key = repr(key)
+
+        rows = self.table.get(key, ())
+        if rows and 'build' in self.queues:
+            self.matched.add(key)
+        return rows
+
+    def join(self, row, match):
+        if self.into is not None:
+            return dict(row, **{self.into: match})
+        if match is None:
+            return row
+        return dict(match, **row)
+
+    def put(self, side, row):
+        if side in self.queues:
+            self.queues[side].put(row)
+
+    def close_table(self):
+        try:
+            if 'build' in self.queues:
+                for key, rows in self.table.items():
+                    if key not in self.matched:
+                        for row in rows:
+                            self.queues['build'].put(row)
+        finally:
+            if self.path is not None:
+                self.table.close()
+            for unmatched in self.queues.values():
+                unmatched.put(_DONE)
+
+
+def _key(row, fields):
+    return tuple(row.get(field) for field in fields)
+
+
+@use_context
+class _JoinBuild(Configurable):
+    join = Option(positional=True, required=True)
+
+    @ContextProcessor
+    def create_table(self, context):
+        self.join.open_table()
+        counts = {'rows': 0, 'duplicates': 0}
+
+        try:
+            counts = yield counts
+            print("# Join built from %d rows, %d keys, %d duplicates dropped"
+                  % (counts['rows'], len(self.join.table),
+                     counts['duplicates']))
+        finally:
+            # Let the probe side go, even if this side failed
+            self.join.built.set()
+
+    def __call__(self, counts, context, row):
+        counts['rows'] += 1
+
+        if not self.join.add(row):
+            counts['duplicates'] += 1
+            print("# Duplicate build row for %r" %
+                  (_key(row, self.join.build_key), ))
+
+
+@use_context
+class _JoinProbe(Configurable):
+    join = Option(positional=True, required=True)
+
+    @ContextProcessor
+    def create_counts(self, context):
+        counts = {'rows': 0, 'matched': 0, 'pending': []}
+
+        try:
+            counts = yield counts
+
+            self.join.built.wait()
+            for row in self.flush(counts):
+                context.send(row)
+        finally:
+            self.join.close_table()
+
+        print("# Join probed with %d rows, %d matched" % (counts['rows'],
+                                                         counts['matched']))
+
+    def __call__(self, counts, context, row):
+        counts['pending'].append(row)
+
+        # Probe rows wait for the build side to be done
+        if self.join.built.is_set():
+            yield from self.flush(counts)
+
+    def flush(self, counts):
+        join = self.join
+        pending, counts['pending'] = counts['pending'], []
+
+        for row in pending:
+            counts['rows'] += 1
+
+            matches = join.lookup(row)
+            if matches:
+                counts['matched'] += 1
+                if join.mode == 'anti':
+                    join.put('probe', row)
+                    continue
+                for match in matches:
+                    yield join.join(row, match)
+            elif join.mode == 'inner':
+                join.put('probe', row)
+            elif join.mode == 'anti':
+                yield row
+            else:
+                yield join.join(row, None)
+
+
+@use_no_input
+class _JoinUnmatched(Configurable):
+    join = Option(positional=True, required=True)
+    side = Option(str, positional=True, required=True)
+
+    def __call__(self):
+        unmatched = self.join.queues[self.side]
+        while True:
+            row = unmatched.get()
+            if row is _DONE:
+                return
+            yield row
+
@@ -0,0 +1,146 @@
+import datetime
+
+from bonobo.config import Configurable, ContextProcessor, Option, Service, use_context
+from bonobo.constants import NOT_MODIFIED
+from sqlalchemy import Column, DateTime, MetaData, String, Table, and_, select
+
+LEDGER_TABLE = 'etl_submission_ledger'
+
+
+class SubmissionLedger:
+    """
+    Remembers which records a job already submitted to an external system,
+    by key (a transaction id, ...) within a namespace, so reruns and
+    backfills only send what was never sent.
+
+    Like SourceStateStore, any SQLAlchemy engine works and the table is
+    created on first use. Keys are stored as strings.
+    """
+
+    def __init__(self, engine, namespace, table_name=LEDGER_TABLE,
+                 batch_size=1000):
+        self.engine = engine
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.table = Table(
+            table_name,
+            MetaData(),
+            Column('namespace', String(64), primary_key=True),
+            Column('key', String(255), primary_key=True),
+            Column('reference', String(255)),
+            Column('submitted_at', DateTime),
+        )
+        self.table.create(engine, checkfirst=True)
+
+    def submitted(self, keys):
+        """Subset of keys already in the ledger, as strings"""
+        keys = list({str(key) for key in keys})
+        found = set()
+
+        with self.engine.connect() as connection:
+            for i in range(0, len(keys), self.batch_size):
+                found.update(row.key for row in connection.execute(
+                    select([self.table.c.key]).where(
+                        and_(self.table.c.namespace == self.namespace,
+                             self.table.c.key.in_(
+                                 keys[i:i + self.batch_size])))))
+
+        return found
+
+    def record(self, entries):
+        """Add (key, reference) pairs to the ledger, replacing known keys"""
+        entries = {str(key): reference for key, reference in entries}
+        if not entries:
+            return
+
+        now = datetime.datetime.now()
+        keys = list(entries)
+
+        with self.engine.begin() as connection:
+            for i in range(0, len(keys), self.batch_size):
+                connection.execute(self.table.delete().where(
+                    and_(self.table.c.namespace == self.namespace,
+                         self.table.c.key.in_(keys[i:i + self.batch_size]))))
+            connection.execute(self.table.insert(), [{
+                'namespace': self.namespace,
+                'key': key,
+                'reference': reference,
+                'submitted_at': now,
+            } for key, reference in entries.items()])
+
+
+@use_context
+class SkipSubmitted(Configurable):
+    """
+    Drop the rows whose key field is already in the ledger service. Rows are
+    checked batch_size at a time, one query per batch.
+    """
+    key = Option(str, positional=True)  # type: str
+    batch_size = Option(int, required=False, default=1000)  # type: int
+
+    ledger = Service('ledger')  # type: str
+
+    @ContextProcessor
+    def create_buffer(self, context, *, ledger):
+        buffer = yield {'rows': [], 'skipped': 0}
+
+        for row in self.filter(buffer, ledger):
+            context.send(row)
+
+        print("# Skipped %d rows already submitted" % buffer['skipped'])
+
+    def __call__(self, buffer, context, row, ledger):
+        buffer['rows'].append(row)
+        if len(buffer['rows']) >= self.batch_size:
+            yield from self.filter(buffer, ledger)
+
+    def filter(self, buffer, ledger):
+        rows, buffer['rows'] = buffer['rows'], []
+        if not rows:
+            return
+
+        submitted = ledger.submitted(row[self.key] for row in rows)
+        for row in rows:
+            if str(row[self.key]) in submitted:
+                buffer['skipped'] += 1
+            else:
+                yield row
+
+
+@use_context
+class RecordSubmitted(Configurable):
+    """
+    Add the records coming back from a submission to the ledger service,
+    keyed on their key field with their reference field (the sys_id of the
+    created record, ...). Records are passed through unchanged.
+
+    Entries are written batch_size at a time and when the node stops, so a
+    crash can leave up to a batch that was sent but not recorded.
+    """
+    key = Option(str, positional=True)  # type: str
+    reference = Option(str, required=False, default='sys_id')  # type: str
+    batch_size = Option(int, required=False, default=1000)  # type: int
+
+    ledger = Service('ledger')  # type: str
+
+    @ContextProcessor
+    def create_buffer(self, context, *, ledger):
+        buffer = yield []
+
+        ledger.record(buffer)
+
+    def __call__(self, buffer, context, record, ledger):
+        if not _failed(record) and record.get(self.key) not in (None, ''):
+            buffer.append((record[self.key], record.get(self.reference)))
+
+            if len(buffer) >= self.batch_size:
+                ledger.record(buffer)
+                buffer.clear()
+
+        return NOT_MODIFIED
+
+
+def _failed(record):
+    # Import set responses flag the records that were not created
+    return record.get('__status') in ('failure', 'error') or \
+        record.get('status') == 'error'
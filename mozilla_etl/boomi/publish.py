@@ -0,0 +1,135 @@
+import hashlib
+import io
+import os
+import tempfile
+
+from fs import errors
+from fs.base import FS
+from fs.mode import Mode
+from fs.path import basename, dirname, join
+from fs.wrapfs import WrapFS
+
+
+class PublishingFS(WrapFS):
+    """
+    Filesystem wrapper only uploading the files written through it when
+    their content changed.
+
+    Files opened for writing (w or w+) are written to a local temporary file
+    and hashed. When closed, they are compared with the size of the
+    remote file and the hash stored next to it (in a hidden .<name>.sha256
+    file), and only uploaded if different, to a hidden temporary name first
+    then renamed over the remote file, so readers never see it half written.
+    Other modes go straight to the wrapped filesystem.
+    """
+
+    def openbin(self, path, mode='r', buffering=-1, **options):
+        _mode = Mode(mode)
+        if not _mode.truncate:
+            return super().openbin(path, mode, buffering, **options)
+
+        self.check()
+        return PublishFile(self, self.validatepath(path))
+
+    def open(self, path, mode='r', buffering=-1, encoding=None, errors=None,
+             newline='', **options):
+        # FS.open goes through self.openbin, WrapFS.open would bypass it
+        return FS.open(self, path, mode, buffering, encoding, errors, newline,
+                       **options)
+
+    def publish(self, path, local, digest, size):
+        remote = self.delegate_fs()
+        sidecar = join(dirname(path), '.%s.sha256' % basename(path))
+        stored = '%s %d' % (digest, size)
+
+        try:
+            unchanged = remote.getsize(path) == size and \
+                remote.readtext(sidecar).strip() == stored
+        except errors.ResourceNotFound:
+            unchanged = False
+
+        if unchanged:
+            print("# %s unchanged, not uploaded" % path)
+            return
+
+        part = join(dirname(path), '.%s.part' % basename(path))
+        with open(local, 'rb') as file:
+            remote.upload(part, file)
+        _rename(remote, part, path)
+        remote.writetext(sidecar, stored + '\n')
+
+        print("# Published %s, %d bytes" % (path, size))
+
+
+class PublishFile(io.RawIOBase):
+    """Local temporary file, published when closed"""
+
+    def __init__(self, publisher, path):
+        self._publisher = publisher
+        self._path = path
+
+        fd, self._local = tempfile.mkstemp(prefix='publish-')
+        self._file = os.fdopen(fd, 'w+b')
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def truncate(self, size=None):
+        return self._file.truncate(size)
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer)
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def flush(self):
+        if not self._file.closed:
+            self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            digest = hashlib.sha256()
+            self._file.seek(0)
+            for chunk in iter(lambda: self._file.read(1024 * 1024), b''):
+                digest.update(chunk)
+            size = self._file.tell()
+            self._file.close()
+
+            self._publisher.publish(self._path, self._local,
+                                    digest.hexdigest(), size)
+        finally:
+            self._file.close()
+            os.unlink(self._local)
+            super().close()
+
+
+def _rename(remote, src, dst):
+    # SFTP renames in place, where fs would copy then remove
+    sftp = getattr(remote, '_sftp', None)
+    if sftp is None:
+        remote.move(src, dst, overwrite=True)
+        return
+
+    try:
+        sftp.posix_rename(src, dst)
+    except IOError:
+        # Servers without the posix-rename extension won't rename over a file
+        if remote.exists(dst):
+            remote.remove(dst)
+        sftp.rename(src, dst)
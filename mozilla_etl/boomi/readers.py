@@ -0,0 +1,50 @@
+from bonobo.config import Configurable, Option, Service, use_context
+from sqlalchemy import text
+
+
+@use_context
+class StreamingSelect(Configurable):
+    """
+    Reads the rows of a query, running it once and sending rows downstream
+    while the rest of the result is still being fetched.
+
+    Unlike bonobo_sqlalchemy.Select, there is no LIMIT/OFFSET pagination
+    re-running the query for every page: the result is read through a
+    server-side cursor (a named cursor with psycopg2, an unbuffered one with
+    mysqlclient, vertica_python streams already) chunk_size rows at a time,
+    so memory stays flat however large the result is.
+
+    Parameters are bound, use :name placeholders in the query.
+    """
+    query = Option(str, positional=True)  # type: str
+    parameters = Option(dict, required=False, default=None)  # type: dict
+    chunk_size = Option(int, required=False, default=5000)  # type: int
+
+    engine = Service('sqlalchemy.engine')  # type: str
+
+    def formatter(self, context, index, row):
+        if not index:
+            context.set_output_fields(row.keys())
+        return tuple(row)
+
+    def __call__(self, context, *, engine):
+        query = text(self.query.strip(' \n;'))
+
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(
+                query, **(self.parameters or {}))
+
+            try:
+                index = 0
+                while True:
+                    rows = result.fetchmany(self.chunk_size)
+                    if not rows:
+                        break
+
+                    for row in rows:
+                        formatted_row = self.formatter(context, index, row)
+                        index += 1
+                        if formatted_row:
+                            yield formatted_row
+            finally:
+                result.close()
@@ -0,0 +1,140 @@
+import datetime
+import time
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import MetaData, Table, func, select, text
+
+from .bulk import get_flavour
+
+# Past this fraction of expired rows, rebuilding the table beats deleting
+SWAP_FRACTION = 0.5
+
+# Below this fraction of deleted rows, don't bother reclaiming space
+VACUUM_FRACTION = 0.05
+
+REBUILD_DDL = {
+    'postgresql': 'CREATE TABLE {new} (LIKE {table} INCLUDING ALL)',
+    'redshift': 'CREATE TABLE {new} (LIKE {table})',
+    'vertica': 'CREATE TABLE {new} LIKE {table} INCLUDING PROJECTIONS',
+}
+
+MAINTENANCE = {
+    'postgresql': ('VACUUM {table}', 'ANALYZE {table}'),
+    'redshift': ('VACUUM DELETE ONLY {table}', 'ANALYZE {table}'),
+    'vertica': ("SELECT PURGE_TABLE('{table}')",
+                "SELECT ANALYZE_STATISTICS('{table}')"),
+}
+
+
+def apply_retention(engine,
+                    table_name,
+                    column,
+                    cutoff,
+                    swap_fraction=SWAP_FRACTION,
+                    vacuum_fraction=VACUUM_FRACTION):
+    """
+    Remove the rows of table_name whose column is before cutoff.
+
+    Rows are deleted one month at a time, each in its own transaction, unless
+    more than swap_fraction of the table is expired, in which case the rows
+    to keep are copied into a new table swapped in place of the old one
+    (grants on the old table are not carried over, and views on it break).
+    Rows without a column value are kept either way. VACUUM and ANALYZE, or
+    their equivalent, only run when enough of the table changed.
+
+    :return: dict of rows removed, rows kept, method used and elapsed seconds
+    """
+    started = time.time()
+
+    table = Table(table_name, MetaData(), autoload=True, autoload_with=engine)
+    column = table.c[column]
+
+    if isinstance(cutoff, datetime.datetime):
+        cutoff = cutoff.date()
+
+    with engine.connect() as connection:
+        flavour = get_flavour(connection)
+        total = connection.execute(select([func.count()]).select_from(
+            table)).scalar()
+        expired, oldest = connection.execute(
+            select([func.count(), func.min(column)]).where(
+                column < cutoff)).fetchone()
+
+    report = {
+        'removed': 0,
+        'kept': total,
+        'method': None,
+        'elapsed': 0,
+    }
+
+    if expired:
+        if flavour in REBUILD_DDL and expired >= total * swap_fraction:
+            report['method'] = 'swap'
+            _swap(engine, flavour, table, column, cutoff)
+        else:
+            report['method'] = 'delete'
+            _delete_by_month(engine, table, column, oldest, cutoff)
+
+        report['removed'] = expired
+        report['kept'] = total - expired
+
+        if flavour in MAINTENANCE:
+            vacuum, analyze = MAINTENANCE[flavour]
+            if report['method'] == 'swap':
+                _maintain(engine, table, analyze)
+            elif expired >= total * vacuum_fraction:
+                _maintain(engine, table, vacuum, analyze)
+
+    report['elapsed'] = time.time() - started
+
+    print("# Cleanup %s: removed %d rows before %s, kept %d (%s, %.1fs)" %
+          (table_name, report['removed'], cutoff, report['kept'],
+           report['method'] or 'nothing to do', report['elapsed']))
+
+    return report
+
+
+def _delete_by_month(engine, table, column, oldest, cutoff):
+    # Same as cutoff, DATETIME and TIMESTAMP columns give datetimes
+    if isinstance(oldest, datetime.datetime):
+        oldest = oldest.date()
+
+    start = oldest + relativedelta(day=1)
+
+    while start < cutoff:
+        end = min(start + relativedelta(months=1), cutoff)
+        with engine.begin() as connection:
+            connection.execute(table.delete().where(
+                (column >= start) & (column < end)))
+        start = end
+
+
+def _swap(engine, flavour, table, column, cutoff):
+    quote = engine.dialect.identifier_preparer.quote
+    name = quote(table.name)
+    new, old = quote(table.name + '_retained'), quote(table.name + '_expired')
+
+    with engine.begin() as connection:
+        connection.execute(text(REBUILD_DDL[flavour].format(
+            new=new, table=name)))
+        connection.execute(
+            text('INSERT INTO {new} SELECT * FROM {table} WHERE {column} >= '
+                 ':cutoff OR {column} IS NULL'.format(
+                     new=new, table=name, column=quote(column.name))),
+            cutoff=cutoff)
+        connection.execute(
+            text('ALTER TABLE {table} RENAME TO {old}'.format(
+                table=name, old=old)))
+        connection.execute(
+            text('ALTER TABLE {new} RENAME TO {table}'.format(
+                new=new, table=name)))
+        connection.execute(text('DROP TABLE {old}'.format(old=old)))
+
+
+def _maintain(engine, table, *statements):
+    # VACUUM refuses to run inside a transaction block
+    with engine.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        for statement in statements:
+            connection.execute(text(statement.format(table=table.name)))
@@ -180,7 +180,7 @@ if __name__ == '__main__':
 
         __package__ = '.'.join(me)
 
-    from .. import add_default_arguments, add_default_services
+    from .. import add_default_arguments, add_default_services, default_plugins
 
     parser = bonobo.get_argument_parser()
 
@@ -190,6 +190,12 @@ if __name__ == '__main__':
         services = get_services(**options)
         add_default_services(services, options)
 
-        bonobo.run(get_sheet_graph(**options), services=services)
+        bonobo.run(
+            get_sheet_graph(**options),
+            services=services,
+            plugins=default_plugins(services))
 
-        bonobo.run(get_sched_graph(**options), services=services)
+        bonobo.run(
+            get_sched_graph(**options),
+            services=services,
+            plugins=default_plugins(services))
@@ -0,0 +1,131 @@
+import collections
+import concurrent.futures
+import json
+import sys
+import time
+
+import requests
+from urllib3.exceptions import NewConnectionError
+from bonobo.config import Configurable, ContextProcessor, Option, Service, use_context
+
+# Statuses telling the records weren't inserted, ServiceNow answers 429 when
+# rate limiting. Other 5xx may come after the insert went through.
+RETRY_STATUSES = (429, 503)
+
+
+def _never_sent(exc):
+    """Whether a failed request can't have reached the server"""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+@use_context
+class InsertMultiple(Configurable):
+    """
+    Send rows to a ServiceNow sysparm_action=insertMultiple endpoint, in
+    batches of batch_size records posted concurrently by a pool of workers.
+
+    insertMultiple isn't idempotent, so only requests that can't have created
+    anything are retried, with exponential backoff (or as told by
+    Retry-After): failing to connect, or answered with a 429 or a 503. A
+    read timeout or a dropped connection fails the batch. The records
+    ServiceNow answers with are sent downstream, each carrying the key field
+    of the row it was created from. A batch failing for good is reported as
+    an error and its rows are not sent downstream.
+    """
+    url = Option(str, positional=True)  # type: str
+    key = Option(str, required=False, default='u_transactionid')  # type: str
+    batch_size = Option(int, required=False, default=100)  # type: int
+    workers = Option(int, required=False, default=4)  # type: int
+    retries = Option(int, required=False, default=5)  # type: int
+    backoff = Option(float, required=False, default=1.0)  # type: float
+    timeout = Option(float, required=False, default=120.0)  # type: float
+
+    session = Service('servicenow')  # type: str
+
+    @ContextProcessor
+    def create_batches(self, context, *, session):
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as pool:
+            batches = yield {
+                'pool': pool,
+                'rows': [],
+                'pending': collections.deque(),
+            }
+
+            self.submit(batches, session)
+            for record in self.collect(
+                    context, batches, wait=len(batches['pending'])):
+                context.send(record)
+
+    def __call__(self, batches, context, row, session):
+        batches['rows'].append(row)
+        if len(batches['rows']) >= self.batch_size:
+            self.submit(batches, session)
+
+        # Don't let batches pile up faster than they are posted
+        yield from self.collect(
+            context, batches, wait=len(batches['pending']) - 2 * self.workers)
+
+    def submit(self, batches, session):
+        if not batches['rows']:
+            return
+
+        rows, batches['rows'] = batches['rows'], []
+        batches['pending'].append((rows, batches['pool'].submit(
+            self.post, session, rows)))
+
+    def collect(self, context, batches, wait=0):
+        """
+        Yield the records of finished batches in submission order, waiting for
+        the oldest ones to finish if wait is set.
+        """
+        pending = batches['pending']
+        while pending and (wait > 0 or pending[0][1].done()):
+            wait -= 1
+            rows, future = pending.popleft()
+            try:
+                yield from future.result()
+            except Exception:
+                print("# Failed to submit %d records, %s to %s" %
+                      (len(rows), rows[0].get(self.key),
+                       rows[-1].get(self.key)))
+                context.error(sys.exc_info())
+
+    def post(self, session, rows):
+        data = json.dumps({'records': rows})
+
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                resp = session.post(self.url, data=data, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last or not _never_sent(e):
+                    raise
+                time.sleep(self.backoff * 2**attempt)
+                continue
+
+            if resp.status_code not in RETRY_STATUSES or last:
+                break
+
+            time.sleep(self.delay(resp, attempt))
+
+        resp.raise_for_status()
+
+        records = resp.json().get('records') or []
+
+        # Records come back in the order they were sent
+        if len(records) == len(rows):
+            for row, record in zip(rows, records):
+                if record.get(self.key) in (None, ''):
+                    record[self.key] = row.get(self.key)
+
+        return records
+
+    def delay(self, resp, attempt):
+        try:
+            return float(resp.headers['Retry-After'])
+        except (KeyError, ValueError):
+            return self.backoff * 2**attempt
@@ -0,0 +1,54 @@
+import threading
+
+from sqlalchemy import create_engine
+
+# Each bonobo node holds at most one connection, a handful of loaders per
+# engine is all a job ever runs concurrently.
+POOL_SIZE = 2
+MAX_OVERFLOW = 6
+
+# Redshift and Vertica drop idle sessions, recycle well before they do
+POOL_RECYCLE = 1800
+
+
+def lazy(factory, *args, **kwargs):
+    """
+    Wrap a service factory so it is only called the first time a node uses the
+    service, the same instance being handed out after that, including to the
+    following bonobo.run() calls sharing the services dict.
+
+    bonobo's service container calls plain functions it finds in the services
+    dict with itself as argument, which is what makes this work. Code using
+    the services dict directly should go through resolve().
+    """
+    lock = threading.Lock()
+    instance = []
+
+    def service(container=None):
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory(*args, **kwargs))
+        return instance[0]
+
+    service.factory = factory
+    service.built = lambda: bool(instance)
+    return service
+
+
+def resolve(services, name):
+    """Get a service out of a services dict, building it if it is lazy"""
+    service = services[name]
+    if callable(getattr(service, 'built', None)):
+        return service()
+    return service
+
+
+def create_pooled_engine(url, **kwargs):
+    """create_engine() with pool settings suited to long ETL jobs"""
+    kwargs.setdefault('echo', False)
+    kwargs.setdefault('pool_size', POOL_SIZE)
+    kwargs.setdefault('max_overflow', MAX_OVERFLOW)
+    kwargs.setdefault('pool_recycle', POOL_RECYCLE)
+    kwargs.setdefault('pool_pre_ping', True)
+    return create_engine(url, **kwargs)
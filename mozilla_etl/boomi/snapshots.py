@@ -0,0 +1,171 @@
+import datetime
+import hashlib
+import json
+
+from bonobo.config import Configurable, ContextProcessor, Option, Service, use_context
+from bonobo.constants import NOT_MODIFIED
+from sqlalchemy import Column, DateTime, MetaData, String, Table, and_, select
+
+SNAPSHOT_TABLE = 'etl_snapshots'
+
+# Where SkipUnchanged leaves the new digest of a changed row
+DIGEST_FIELD = '_digest'
+
+
+class SnapshotStore:
+    """
+    Remembers a digest of each record a job saw on its previous run, by key
+    (an employee id, ...) within a namespace, so the next run can tell which
+    records changed since.
+
+    Like SourceStateStore, any SQLAlchemy engine works and the table is
+    created on first use.
+    """
+
+    def __init__(self, engine, namespace, table_name=SNAPSHOT_TABLE,
+                 batch_size=1000):
+        self.engine = engine
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.table = Table(
+            table_name,
+            MetaData(),
+            Column('namespace', String(64), primary_key=True),
+            Column('key', String(255), primary_key=True),
+            Column('digest', String(40)),
+            Column('updated_at', DateTime),
+        )
+        self.table.create(engine, checkfirst=True)
+
+    def digests(self):
+        """All the digests of the namespace, by key"""
+        with self.engine.connect() as connection:
+            return {
+                row.key: row.digest
+                for row in connection.execute(
+                    select([self.table.c.key, self.table.c.digest]).where(
+                        self.table.c.namespace == self.namespace))
+            }
+
+    def update(self, digests):
+        """Set the digests of a dict of keys to digests"""
+        digests = {str(key): digest for key, digest in digests.items()}
+        if not digests:
+            return
+
+        now = datetime.datetime.now()
+        with self.engine.begin() as connection:
+            self._delete(connection, list(digests))
+            connection.execute(self.table.insert(), [{
+                'namespace': self.namespace,
+                'key': key,
+                'digest': digest,
+                'updated_at': now,
+            } for key, digest in digests.items()])
+
+    def forget(self, keys):
+        keys = list({str(key) for key in keys})
+        if not keys:
+            return
+
+        with self.engine.begin() as connection:
+            self._delete(connection, keys)
+
+    def _delete(self, connection, keys):
+        for i in range(0, len(keys), self.batch_size):
+            connection.execute(self.table.delete().where(
+                and_(self.table.c.namespace == self.namespace,
+                     self.table.c.key.in_(keys[i:i + self.batch_size]))))
+
+
+def digest(row, fields=None):
+    """Stable digest of a dict row, or of some of its fields"""
+    if fields is not None:
+        row = {field: row.get(field) for field in fields}
+    return hashlib.sha1(
+        json.dumps(row, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+@use_context
+class SkipUnchanged(Configurable):
+    """
+    Only let through the rows that changed since the previous run, as told by
+    the digest of their fields (all of them by default) kept in the
+    snapshots service under their key field.
+
+    Nothing is saved here, changed rows carry their new digest in
+    digest_field for CommitSnapshots to save once they were dealt with.
+    When the node stops, the snapshots of keys not seen this run are
+    dropped, unless readonly is set.
+    """
+    key = Option(str, positional=True)  # type: str
+    fields = Option(tuple, required=False, default=None)  # type: tuple
+    digest_field = Option(str, required=False, default=DIGEST_FIELD)  # type: str
+    readonly = Option(bool, required=False, default=False)  # type: bool
+
+    snapshots = Service('snapshots')  # type: str
+
+    @ContextProcessor
+    def create_snapshot(self, context, *, snapshots):
+        snapshot = yield {
+            'previous': snapshots.digests(),
+            'changed': 0,
+            'seen': set(),
+        }
+
+        gone = set(snapshot['previous']) - snapshot['seen']
+
+        print("# %d rows changed, %d unchanged, %d gone since last run" %
+              (snapshot['changed'],
+               len(snapshot['seen']) - snapshot['changed'], len(gone)))
+
+        if not self.readonly:
+            snapshots.forget(gone)
+
+    def __call__(self, snapshot, context, row, snapshots):
+        key = str(row[self.key])
+        row_digest = digest(row, self.fields)
+
+        snapshot['seen'].add(key)
+        if snapshot['previous'].get(key) == row_digest:
+            return
+
+        snapshot['changed'] += 1
+        row[self.digest_field] = row_digest
+        return row
+
+
+@use_context
+class CommitSnapshots(Configurable):
+    """
+    Save the digests SkipUnchanged put in the rows matching predicate (all
+    of them by default), so they are skipped on the next run. Placed after
+    the stage acting on the rows, the ones it failed, or never got to, are
+    seen as changed again next time.
+
+    Digests are saved buffer_size at a time, and rows passed through
+    unchanged.
+    """
+    key = Option(str, positional=True)  # type: str
+    predicate = Option(required=False, default=None)
+    digest_field = Option(str, required=False, default=DIGEST_FIELD)  # type: str
+    buffer_size = Option(int, required=False, default=1000)  # type: int
+
+    snapshots = Service('snapshots')  # type: str
+
+    @ContextProcessor
+    def create_buffer(self, context, *, snapshots):
+        digests = yield {}
+
+        snapshots.update(digests)
+
+    def __call__(self, digests, context, row, snapshots):
+        if row.get(self.digest_field) and \
+                (self.predicate is None or self.predicate(row)):
+            digests[row[self.key]] = row[self.digest_field]
+
+            if len(digests) >= self.buffer_size:
+                snapshots.update(digests)
+                digests.clear()
+
+        return NOT_MODIFIED
@@ -0,0 +1,75 @@
+import datetime
+
+from sqlalchemy import BigInteger, Column, DateTime, MetaData, String, Table, and_, select
+
+STATE_TABLE = 'etl_source_state'
+
+
+class SourceStateStore:
+    """
+    Remembers what was last loaded from each input source (a file, an S3
+    object, ...) so jobs can skip sources that did not change since the
+    previous run.
+
+    Sources are tracked within a namespace, naming where they were loaded
+    (engine and table, ...), so loading the same source somewhere else
+    doesn't count as done.
+
+    Any SQLAlchemy engine works, sqlite for local runs and the target
+    warehouse in production. The table is created on first use.
+    """
+
+    def __init__(self, engine, namespace, table_name=STATE_TABLE):
+        self.engine = engine
+        self.namespace = namespace
+        self.table = Table(
+            table_name,
+            MetaData(),
+            Column('namespace', String(255), primary_key=True),
+            Column('source', String(255), primary_key=True),
+            Column('etag', String(255)),
+            Column('size', BigInteger),
+            Column('row_count', BigInteger),
+            Column('updated_at', DateTime),
+        )
+        self.table.create(engine, checkfirst=True)
+
+    def get(self, source):
+        with self.engine.connect() as connection:
+            row = connection.execute(
+                select([self.table]).where(
+                    self._where(source))).fetchone()
+        return dict(row) if row else None
+
+    def sources(self):
+        with self.engine.connect() as connection:
+            return [
+                row.source for row in connection.execute(
+                    select([self.table.c.source]).where(
+                        self.table.c.namespace == self.namespace))
+            ]
+
+    def set(self, source, etag=None, size=None, row_count=None):
+        with self.engine.begin() as connection:
+            connection.execute(self.table.delete().where(self._where(source)))
+            connection.execute(self.table.insert().values(
+                namespace=self.namespace,
+                source=source,
+                etag=etag,
+                size=size,
+                row_count=row_count,
+                updated_at=datetime.datetime.now()))
+
+    def forget(self, sources):
+        sources = list(sources)
+        if not sources:
+            return
+
+        with self.engine.begin() as connection:
+            connection.execute(self.table.delete().where(
+                and_(self.table.c.namespace == self.namespace,
+                     self.table.c.source.in_(sources))))
+
+    def _where(self, source):
+        return and_(self.table.c.namespace == self.namespace,
+                    self.table.c.source == source)
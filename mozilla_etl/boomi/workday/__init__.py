@@ -12,6 +12,8 @@ from requests.auth import HTTPBasicAuth
 
 from sqlalchemy import create_engine
 
+from .reports import read_report
+
 SN_TEST_URL = 'https://mozilla.service-now.com/alm_license.do?JSONv2&sysparm_query=model%3Da669b9840ffa4200f67ab65be1050e49'
 
 
@@ -14,41 +14,16 @@ WORKDAY_BASE_URL = 'https://wd2-impl-services1.workday.com'
 COST_CENTERS_QUERY = '/ccx/service/customreport2/vhr_mozilla/ISU_RAAS/intg__Business_Units_Feed?Organizations%21WID=4f414049b78141f3981464563b36ba46!7f8db47cd30d4cdfa5670e37ee0df3ad&Include_Subordinate_Organizations=1&format=csv&bom=true'
 BU_QUERY = '/ccx/service/customreport2/vhr_mozilla/ISU_RAAS/intg__Supervisory_Orgs_Feed?format=csv&bom=true'
 
-_cache = {}
-
-
-def cache(self, context):
-    yield _cache
-
-
 @use('workday')
 def get_cost_centers(workday):
     """Retrieve cost centers from WorkDay"""
-    resp = workday.get(WORKDAY_BASE_URL + COST_CENTERS_QUERY)
-
-    stream = io.StringIO(resp.content.decode("utf-8-sig"))
-
-    data = csv.reader(stream)
-
-    headers = next(data)
-
-    for row in data:
-        yield dict(zip(headers, row))
+    yield from read_report(workday, WORKDAY_BASE_URL + COST_CENTERS_QUERY)
 
 
 @use('workday')
 def get_business_units(workday):
     """Retrieve Business Units from WorkDay"""
-    resp = workday.get(WORKDAY_BASE_URL + BU_QUERY)
-
-    stream = io.StringIO(resp.content.decode("utf-8-sig"))
-
-    data = csv.reader(stream)
-
-    headers = next(data)
-
-    for row in data:
-        yield dict(zip(headers, row))
+    yield from read_report(workday, WORKDAY_BASE_URL + BU_QUERY)
 
 
 import collections
@@ -66,14 +41,8 @@ def centerstone_CostCenter_remap(row):
     yield dict
 
 
-@use_context_processor(cache)
-def join_cost_centers(cache, row):
-    if row['Cost_Center'] in cache:
-        row['Cost_Center_Details'] = cache[row['Cost_Center']]
-        yield row
-    else:
-        # print("Encountered record without a known cost center %r" % row)
-        raise ValueError("Encountered record without a known cost center", row)
+def unknown_cost_center(row):
+    raise ValueError("Encountered record without a known cost center", row)
 
 
 def centerstone_BU_SupOrg_Merge_remap(row):
@@ -141,15 +110,49 @@ def teamLevel3_remap(row):
     yield dict
 
 
-def get_bu_graph(**options):
+def get_graph(**options):
+    """
+    This function builds the graph that needs to be executed.
+
+    Both reports download at the same time, the business units only wait for
+    the cost centers to be hashed before being joined to them.
+
+    :return: bonobo.Graph
+
+    """
     graph = bonobo.Graph()
+
+    split_cost_centers = bonobo.noop
+
+    join_cost_centers = HashJoin(
+        ('Cost_Center', ), into='Cost_Center_Details', unique=True)
+
+    graph.add_chain(
+        get_cost_centers, split_cost_centers, join_cost_centers.build)
+
+    graph.add_chain(
+        centerstone_CostCenter_remap,
+        #bonobo.PrettyPrinter(),
+        bonobo.UnpackItems(0),
+        # Can't skip the header, but must
+        bonobo.CsvWriter(
+            '/etl/centerstone/downloads/CostCenterLevel2.txt' +
+            options['suffix'],
+            lineterminator="\n",
+            delimiter="\t",
+            fs="brickftp"),
+        bonobo.count,
+        _input=split_cost_centers)
+
     graph.add_chain(
         get_business_units,
-        join_cost_centers,
+        join_cost_centers.probe,
         centerstone_BU_SupOrg_Merge_remap,
         centerstone_BussUnit_remap,
     )
 
+    graph.add_chain(join_cost_centers.unmatched, unknown_cost_center)
+
     graph.add_chain(
         #bonobo.Limit(3),
         #bonobo.PrettyPrinter(),
@@ -164,6 +167,7 @@ def get_bu_graph(**options):
             delimiter="\t",
             fs="brickftp"),
         _input=centerstone_BussUnit_remap)
+
     graph.add_chain(
         teamLevel3_remap,
         bonobo.UnpackItems(0),
@@ -177,39 +181,6 @@ def get_bu_graph(**options):
     return graph
 
 
-@use_context_processor(cache)
-def cache_cost_centers(cache, row):
-    cache[row['Cost_Center']] = row
-    return NOT_MODIFIED
-
-
-def get_costcenter_graph(**options):
-    """
-    This function builds the graph that needs to be executed.
-
-    :return: bonobo.Graph
-
-    """
-    graph = bonobo.Graph()
-    graph.add_chain(
-        get_cost_centers,
-        cache_cost_centers,
-        centerstone_CostCenter_remap,
-        #bonobo.PrettyPrinter(),
-        bonobo.UnpackItems(0),
-        # Can't skip the header, but must
-        bonobo.CsvWriter(
-            '/etl/centerstone/downloads/CostCenterLevel2.txt' +
-            options['suffix'],
-            lineterminator="\n",
-            delimiter="\t",
-            fs="brickftp"),
-        bonobo.count,
-        _name="main")
-
-    return graph
-
-
 def get_services(**options):
     """
     This function builds the services dictionary, which is a simple dict of names-to-implementation used by bonobo
@@ -247,7 +218,8 @@ if __name__ == '__main__':
 
         __package__ = '.'.join(me)
 
-    from ... import add_default_arguments, add_default_services
+    from ... import add_default_arguments, add_default_services, default_plugins, HashJoin
+    from .. import read_report
 
     parser = bonobo.get_argument_parser()
     add_default_arguments(parser)
@@ -256,13 +228,7 @@ if __name__ == '__main__':
         services = get_services(**options)
         add_default_services(services, options)
 
-        costcenter_g = get_costcenter_graph(**options)
-        bu_g = get_bu_graph(**options)
-
-        # Run CostCenter process
-        print("# Running CostCenter process")
-        bonobo.run(costcenter_g, services=services)
-
-        # Run Business Unit process
-        print("# Running Business Unit process")
-        bonobo.run(bu_g, services=services)
+        bonobo.run(
+            get_graph(**options),
+            services=services,
+            plugins=default_plugins(services))
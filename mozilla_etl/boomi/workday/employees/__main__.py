@@ -18,16 +18,7 @@ GET_USERS_QUERY = '/ccx/service/customreport2/vhr_mozilla/ISU_RAAS/intg__Service
 def get_workday_users(workday):
     """Retrieve employees list from WorkDay"""
 
-    resp = workday.get(WORKDAY_BASE_URL + GET_USERS_QUERY)
-
-    stream = io.StringIO(resp.content.decode("utf-8-sig"))
-
-    data = csv.reader(stream)
-
-    headers = next(data)
-
-    for row in data:
-        yield dict(zip(headers, row))
+    yield from read_report(workday, WORKDAY_BASE_URL + GET_USERS_QUERY)
 
 
 import collections
@@ -138,7 +129,8 @@ if __name__ == '__main__':
 
         __package__ = '.'.join(me)
 
-    from ... import add_default_arguments, add_default_services, HeaderlessCsvWriter
+    from ... import add_default_arguments, add_default_services, default_plugins, HeaderlessCsvWriter
+    from .. import read_report
 
     parser = bonobo.get_argument_parser()
     add_default_arguments(parser)
@@ -151,4 +143,7 @@ if __name__ == '__main__':
 
         # Run Workday GET users process
         print("# Running GET Workday Employee process")
-        bonobo.run(users_g, services=services)
+        bonobo.run(
+            users_g,
+            services=services,
+            plugins=default_plugins(services))
@@ -0,0 +1,80 @@
+import csv
+import io
+import time
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkReader(io.RawIOBase):
+    """Readable file over an iterator of bytes chunks, counting them"""
+
+    def __init__(self, chunks, stats):
+        self._chunks = chunks
+        self._stats = stats
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._stats['bytes'] += len(chunk)
+            self._pending = chunk
+
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+
+def read_report(session, url, chunk_size=CHUNK_SIZE):
+    """
+    Rows of a Workday RaaS CSV report, as dicts keyed on its header, yielded
+    while the report downloads.
+
+    The response is streamed (gzip compressed on the wire) and decoded as it
+    arrives, dropping the BOM Workday adds, so memory use doesn't depend on
+    the size of the report. The bytes, rows and timings are printed once the
+    report was read.
+    """
+    started = time.perf_counter()
+    stats = {'bytes': 0, 'rows': 0, 'first_row': None}
+
+    with session.get(
+            url, stream=True, headers={'Accept-Encoding': 'gzip'}) as resp:
+        resp.raise_for_status()
+
+        stream = io.TextIOWrapper(
+            io.BufferedReader(
+                _ChunkReader(resp.iter_content(chunk_size), stats),
+                chunk_size),
+            encoding='utf-8-sig',
+            newline='')
+
+        data = csv.reader(stream)
+
+        headers = next(data, None)
+        if headers is None:
+            return
+
+        for row in data:
+            if stats['first_row'] is None:
+                stats['first_row'] = time.perf_counter() - started
+            stats['rows'] += 1
+            yield dict(zip(headers, row))
+
+        # Cache hits are replayed from a file on disk, not the wire
+        cache_status = getattr(resp, 'cache_status', None)
+        if cache_status in ('hit', 'revalidated'):
+            wire = 'cache %s' % cache_status
+        else:
+            wire = '%d on the wire' % resp.raw.tell()
+
+    print("# Read %d rows, %d bytes (%s) in %.2fs, "
+          "first row after %.2fs, from %s" %
+          (stats['rows'], stats['bytes'], wire,
+           time.perf_counter() - started, stats['first_row'] or 0,
+           url.split('?')[0]))
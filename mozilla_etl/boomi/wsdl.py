@@ -0,0 +1,83 @@
+import hashlib
+import os
+import time
+
+from zeep.cache import Base
+from zeep.transports import Transport
+
+# Revalidate cached WSDL and XSD documents once a day
+WSDL_TTL = 86400
+
+
+class WsdlCache(Base):
+    """
+    zeep cache keeping the WSDL and XSD documents a client loads on local
+    disk, in one directory per tenant and API version, so a run only
+    downloads them again once they are older than ttl seconds.
+
+    When offline, documents are served from disk whatever their age and
+    never downloaded.
+    """
+
+    def __init__(self, path, tenant, version, ttl=WSDL_TTL, offline=False):
+        self.path = os.path.join(path, tenant, version)
+        self.ttl = ttl
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def _filename(self, url):
+        return os.path.join(self.path,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def add(self, url, content):
+        filename = self._filename(url)
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as file:
+            file.write(content)
+        os.replace(tmp, filename)
+
+    def get(self, url):
+        filename = self._filename(url)
+        try:
+            age = time.time() - os.path.getmtime(filename)
+        except OSError:
+            age = None
+
+        if age is not None and (self.offline or age < self.ttl):
+            self.hits += 1
+            return self.stale(url)
+
+        self.misses += 1
+        if self.offline:
+            raise IOError('%s is not in the WSDL cache %s' % (url, self.path))
+
+    def stale(self, url):
+        """Cached content for url whatever its age, None if there is none"""
+        try:
+            with open(self._filename(url), 'rb') as file:
+                return file.read()
+        except OSError:
+            return None
+
+
+class CachingTransport(Transport):
+    """
+    zeep transport loading documents through a WsdlCache, falling back to the
+    expired copy when a document can't be revalidated.
+    """
+
+    def __init__(self, cache, **kwargs):
+        super().__init__(cache=cache, **kwargs)
+
+    def _load_remote_data(self, url):
+        try:
+            return super()._load_remote_data(url)
+        except Exception:
+            content = self.cache.stale(url)
+            if content is None:
+                raise
+            print("# Could not revalidate %s, using the cached copy" % url)
+            return content